@@ -0,0 +1,162 @@
+import os
+import time
+import atexit
+import logging
+import datetime
+import threading
+from Queue import Queue, Full, Empty
+
+from mongoengine.connection import _get_db
+
+logger = logging.getLogger('mongotools.audit')
+
+# what register does when the queue is full
+BLOCK = 'block'
+DROP = 'drop'
+SYNC = 'sync'
+
+_STOP = object()
+
+
+class AuditWriter(object):
+    """
+    Writes historic events in batches from a background thread, so views
+    do not wait for them. Events are queued in-process and inserted into
+    `collection_name` with one insert per `batch_size` events, or every
+    `flush_interval` seconds. Set an instance as the `historic_writer` of
+    the mongotools views to use it instead of `user.register_historic`.
+
+    At most `max_queue` events wait for the thread; when the queue is full
+    `overflow` tells whether to BLOCK the request until there is room, to
+    DROP the event (counted in `dropped`) or to write it right away (SYNC).
+    Queued events are written when the process exits.
+    """
+    collection_name = 'mongotools.historic'
+    batch_size = 100
+    flush_interval = 1.0
+    max_queue = 10000
+    overflow = BLOCK
+
+    def __init__(self, **kwargs):
+        for key, value in kwargs.items():
+            if not hasattr(self.__class__, key):
+                raise TypeError(u"%s got an unexpected keyword argument '%s'"
+                                % (self.__class__.__name__, key))
+            setattr(self, key, value)
+
+        self.queue = Queue(self.max_queue)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+        self.closed = False
+        self.dropped = 0
+        atexit.register(self.close)
+
+    def get_collection(self):
+        return _get_db()[self.collection_name]
+
+    def make_event(self, user, obj, action):
+        """returns the document stored for an historic action.."""
+        return {
+            'user': getattr(user, 'pk', None),
+            'document': obj.__class__.__name__,
+            'object_id': obj.pk,
+            'action': action,
+            'created': datetime.datetime.utcnow(),
+        }
+
+    def register(self, user, obj, action):
+        event = self.make_event(user, obj, action)
+        if self.closed:
+            self.write([event])
+            return
+
+        self.start()
+        try:
+            if self.overflow == BLOCK:
+                self.queue.put(event)
+            else:
+                self.queue.put_nowait(event)
+        except Full:
+            if self.overflow == SYNC:
+                self.write([event])
+            else:
+                self.dropped += 1
+                logger.warning(u'audit queue full, dropped %s event',
+                               action)
+
+    def start(self):
+        """starts the writer thread, again in forked processes.."""
+        if self.thread is not None and self.thread.is_alive() and \
+           self.pid == os.getpid():
+            return
+
+        self.lock.acquire()
+        try:
+            if self.thread is None or not self.thread.is_alive() or \
+               self.pid != os.getpid():
+                if self.pid != os.getpid():
+                    # the queue of the parent process is not shared
+                    self.queue = Queue(self.max_queue)
+                self.pid = os.getpid()
+                self.thread = threading.Thread(target=self.run,
+                                               name='mongotools-audit')
+                self.thread.daemon = True
+                self.thread.start()
+        finally:
+            self.lock.release()
+
+    def run(self):
+        while True:
+            batch = []
+            deadline = time.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    event = self.queue.get(True, timeout)
+                except Empty:
+                    break
+                if event is _STOP:
+                    self.write(batch)
+                    return
+                batch.append(event)
+
+            self.write(batch)
+
+    def write(self, events):
+        if not events:
+            return
+        try:
+            self.get_collection().insert(events)
+        except Exception:
+            # losing audit events must not stop the writer
+            logger.exception(u'could not write %s audit events', len(events))
+
+    def drain(self):
+        events = []
+        while True:
+            try:
+                event = self.queue.get_nowait()
+            except Empty:
+                break
+            if event is not _STOP:
+                events.append(event)
+        self.write(events)
+
+    def close(self, timeout=5):
+        """writes the queued events and stops the thread.."""
+        if self.closed:
+            return
+        self.closed = True
+
+        thread = self.thread
+        if thread is not None and thread.is_alive() and \
+           self.pid == os.getpid():
+            try:
+                self.queue.put(_STOP, True, timeout)
+            except Full:
+                pass
+            thread.join(timeout)
+        self.drain()
@@ -1,15 +1,32 @@
 import types
+from bson import BSON
+from bson.errors import InvalidId
 from django import forms
+from django.core.validators import EMPTY_VALUES
 from django.core.files.uploadedfile import UploadedFile
 from django.utils.datastructures import SortedDict
 from django.forms.widgets import media_property
 
 from mongoengine.base import BaseDocument
 from mongotools.forms.fields import MongoFormFieldGenerator
-from mongotools.forms.utils import mongoengine_validate_wrapper, iter_valid_fields, save_file
-from mongoengine.fields import ReferenceField, FileField, ListField
+from mongotools.forms.fields import ReferenceField as ReferenceFormField
+from mongotools.forms.utils import mongoengine_validate_wrapper, compile_field_plan, save_file, attach_file, reference_id
+from mongotools.forms.utils import release_file
+from mongotools.forms.utils import FILE, REFERENCE, REFERENCE_LIST
+from mongotools.forms.formsets import MongoFormSet, mongoformset_factory
+from mongotools.utils import raw_cursor
 
-__all__ = ('MongoForm',)
+__all__ = ('MongoForm', 'StaleDocumentError', 'MongoFormSet',
+           'mongoformset_factory')
+
+
+# name of the hidden field holding the document version
+VERSION_FIELD = '_version'
+
+
+class StaleDocumentError(Exception):
+
+    """The document was changed by someone else since the form was built."""
 
 
 class MongoFormMetaClass(type):
@@ -41,8 +58,20 @@ class MongoFormMetaClass(type):
 
             widgets = getattr(attrs["Meta"], "widgets", {})
 
+            # list of reference fields cleaned to DBRefs, or True for all
+            lazy_references = getattr(attrs['Meta'], 'lazy_references', ())
+
+            # options of the choices of reference fields, by field name,
+            # like {'author': {'label_fields': ('name',),
+            #                  'choices_cache_timeout': 300}}
+            reference_choices = getattr(attrs['Meta'], 'reference_choices', {})
+
+            # the valid fields are walked once per form class, the
+            # per-request code iterates this plan
+            attrs['_field_plan'] = compile_field_plan(attrs['Meta'])
+
             # walk through the document fields
-            for field_name, field in iter_valid_fields(attrs['Meta']):
+            for field_name, field, kind in attrs['_field_plan']:
                 # add field and override clean method to respect
                 # mongoengine-validator
 
@@ -52,17 +81,31 @@ class MongoFormMetaClass(type):
                 else:
                     widget = widgets.get(field_name, None)
 
+                kwargs = {}
                 if widget:
-                    doc_fields[field_name] = formfield_generator.generate(
-                        field, widget=widget)
-                else:
-                    doc_fields[field_name] = formfield_generator.generate(
-                        field)
+                    kwargs['widget'] = widget
+
+                if kind == REFERENCE_LIST and \
+                   (lazy_references is True or field_name in lazy_references):
+                    kwargs['lazy'] = True
+
+                if kind in (REFERENCE, REFERENCE_LIST):
+                    kwargs.update(reference_choices.get(field_name, {}))
 
-                if not isinstance(field, FileField):
-                    doc_fields[field_name].clean = mongoengine_validate_wrapper(
-                        field,
-                        doc_fields[field_name].clean, field._validate)
+                doc_fields[field_name] = formfield_generator.generate(
+                    field, **kwargs)
+
+            # the version the form was built from travels with the form
+            if getattr(attrs['Meta'], 'version_field', None):
+                doc_fields[VERSION_FIELD] = forms.IntegerField(
+                    widget=forms.HiddenInput, required=False)
+
+            # generated fields get the mongoengine validation once copied
+            # for each form, see MongoForm.__init__
+            attrs['_validated_fields'] = tuple([
+                (field_name, field) for field_name, field, kind in
+                attrs['_field_plan'] if kind != FILE and
+                field_name not in attrs['base_fields']])
 
             # write the new document fields to base_fields
             doc_fields.update(attrs['base_fields'])
@@ -108,14 +151,26 @@ class MongoForm(forms.BaseForm):
             object_data = {}
 
             # walk through the document fields
-            for field_name, field in iter_valid_fields(self._meta):
+            for field_name, field, kind in self._field_plan:
                 # add field data if needed
-                field_data = getattr(instance, field_name)
-                if isinstance(self._meta.document._fields[field_name], ReferenceField):
+                # references are read from the stored values, getattr would
+                # dereference them only to throw the documents away
+                if kind == REFERENCE:
+                    field_data = reference_id(instance._data.get(field_name))
                     # field data could be None for not populated refs
-                    field_data = field_data and str(field_data.id)
+                    field_data = field_data and str(field_data)
+                elif kind == REFERENCE_LIST:
+                    field_data = [str(reference_id(value)) for value in
+                                  instance._data.get(field_name) or []]
+                else:
+                    field_data = getattr(instance, field_name)
                 object_data[field_name] = field_data
 
+            if getattr(self._meta, 'version_field', None):
+                # documents stored without a version are at version 0
+                object_data[VERSION_FIELD] = instance._data.get(
+                    self._meta.version_field) or 0
+
         # additional initial data available?
         if initial is not None:
             object_data.update(initial)
@@ -124,17 +179,110 @@ class MongoForm(forms.BaseForm):
         super(MongoForm, self).__init__(data, files, auto_id, prefix, object_data,
                                         error_class, label_suffix, empty_permitted)
 
+        # an update must tell which version it was built from
+        if VERSION_FIELD in self.fields and not self.instance._adding:
+            self.fields[VERSION_FIELD].required = True
+
+        # files the instance stops pointing at, and files stored for it,
+        # see save
+        self._replaced_files, self._stored_files = [], []
+
+        # wrap the clean of this form's copies of the fields, a wrapper set
+        # on base_fields would keep calling the clean of the base field
+        for field_name, field in getattr(self, '_validated_fields', ()):
+            form_field = self.fields[field_name]
+            form_field.clean = mongoengine_validate_wrapper(
+                field, form_field.clean, field._validate)
+
+    def _prefetch_references(self):
+        """
+        Resolves the submitted ids of all reference fields with a single
+        `$in` query per referenced queryset, and hands the documents to the
+        fields, so cleaning them does not query the database again.
+        """
+        groups = {}
+        for name, field in self.fields.items():
+            if not isinstance(field, ReferenceFormField):
+                continue
+
+            value = field.widget.value_from_datadict(
+                self.data, self.files, self.add_prefix(name))
+            if not isinstance(value, (list, tuple)):
+                value = [value]
+
+            pks = []
+            for v in value:
+                if v in EMPTY_VALUES:
+                    continue
+                try:
+                    pks.append(field.to_pk(v))
+                except (TypeError, ValueError, InvalidId):
+                    # the field raises the proper error when cleaned
+                    continue
+
+            # fields share a query when they reference the same documents
+            queryset = field.queryset
+            key = (queryset._document, BSON.encode(queryset._query))
+            group = groups.setdefault(key, (queryset, set(), []))
+            group[1].update(pks)
+            group[2].append(field)
+
+        for queryset, pks, fields in groups.values():
+            objects = {}
+            if pks:
+                queryset = queryset.clone().filter(pk__in=list(pks))
+
+                # lazy fields only need to know the ids exist
+                if all([getattr(field, 'lazy', False) for field in fields]):
+                    id_field = queryset._document._meta['id_field']
+                    objects = dict([(son['_id'], son['_id']) for son in
+                                    raw_cursor(queryset, [id_field])])
+                else:
+                    objects = dict([(obj.pk, obj) for obj in queryset])
+
+            for field in fields:
+                field.prefetched = objects
+
+    def _clean_fields(self):
+        self._prefetch_references()
+        try:
+            super(MongoForm, self)._clean_fields()
+        finally:
+            for field in self.fields.values():
+                if isinstance(field, ReferenceFormField):
+                    field.prefetched = None
+
     def save(self, commit=True):
-        """save the instance or create a new one.."""
+        """
+        save the instance or create a new one..
+
+        Replaced files are released once the instance is written; without
+        `commit`, call `release_files` after writing it, or `discard_files`
+        if it is not written.
+        """
         # walk through the document fields
-        for field_name, field in iter_valid_fields(self._meta):
+        for field_name, field, kind in self._field_plan:
             # FileFields need some more work to ensure the filename is unique
-            if isinstance(self.instance._fields[field_name], FileField):
+            if kind == FILE:
                 io = self.cleaned_data.get(field_name)
+                previous = getattr(self.instance, field_name).grid_id
 
-                if isinstance(io, UploadedFile):
-                    field = save_file(self.instance, field_name, io)
+                if getattr(io, 'grid_id', None) is not None:
+                    # already streamed into GridFS by the upload handler,
+                    # which discards it if the instance is not written
+                    field = attach_file(self.instance, field_name, io)
+                    setattr(self.instance, field_name, field)
+                    self._replaced_files.append(previous)
+
+                elif isinstance(io, UploadedFile):
+                    field = save_file(self.instance, field_name, io,
+                                      getattr(self._meta, 'filename_strategy',
+                                              'counter'),
+                                      getattr(self._meta, 'deduplicate_files',
+                                              False))
                     setattr(self.instance, field_name, field)
+                    self._replaced_files.append(previous)
+                    self._stored_files.append(field.grid_id)
 
                 continue
 
@@ -142,6 +290,84 @@ class MongoForm(forms.BaseForm):
                 self.instance, field_name, self.cleaned_data.get(field_name))
 
         if commit:
-            self.instance.save()
+            try:
+                if getattr(self._meta, 'delta_save', False) and \
+                   not self.instance._adding:
+                    self._delta_save()
+                else:
+                    self.instance.save()
+            except:
+                self.discard_files()
+                raise
+            self.release_files()
 
         return self.instance
+
+    def release_files(self):
+        """releases the files the written instance replaced.."""
+        for grid_id in self._replaced_files:
+            release_file(grid_id)
+        self._replaced_files, self._stored_files = [], []
+
+    def discard_files(self):
+        """releases the files stored by save for an instance not written.."""
+        for grid_id in self._stored_files:
+            release_file(grid_id)
+        self._replaced_files, self._stored_files = [], []
+
+    def _delta_save(self):
+        """
+        Writes only the changed fields of the instance, with a single atomic
+        `$set`/`$unset` update. When the Meta class names a `version_field`,
+        the update only applies if the stored version is still the one the
+        form was built from, and raises StaleDocumentError otherwise.
+        """
+        document = self.instance
+        to_set, to_unset = {}, {}
+        version_field = getattr(self._meta, 'version_field', None)
+
+        for field_name, field, kind in self._field_plan:
+            if field_name not in self.changed_data or \
+               field_name == version_field:
+                continue
+
+            # the stored values, getattr would dereference references
+            value = document._data.get(field_name)
+            if value is None:
+                to_unset[field.db_field] = 1
+            else:
+                to_set[field.db_field] = field.to_mongo(value)
+
+        spec = {'_id': document.pk}
+        update = {}
+        if to_set:
+            update['$set'] = to_set
+        if to_unset:
+            update['$unset'] = to_unset
+
+        if version_field:
+            db_field = document._fields[version_field].db_field
+            version = self.cleaned_data.get(VERSION_FIELD)
+            if version is None:
+                # without the version there is nothing to check against
+                raise StaleDocumentError(
+                    '%s %s was posted without its version' % (
+                        document.__class__.__name__, document.pk))
+            if version == 0:
+                spec[db_field] = {'$in': [0, None]}
+            else:
+                spec[db_field] = version
+            update['$inc'] = {db_field: 1}
+
+        if not update:
+            return
+
+        collection = document.__class__.objects._collection
+        result = collection.update(spec, update, safe=True)
+
+        if version_field:
+            if not result or not result.get('n'):
+                raise StaleDocumentError(
+                    '%s %s was changed since the form was loaded' % (
+                        document.__class__.__name__, document.pk))
+            setattr(document, version_field, version + 1)
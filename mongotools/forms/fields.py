@@ -2,6 +2,7 @@ from django import forms
 from django.utils.encoding import smart_unicode
 from pymongo.errors import InvalidId
 from bson import ObjectId
+from bson.dbref import DBRef
 from django.core.validators import EMPTY_VALUES
 from django.utils.encoding import smart_unicode, force_unicode
 from django.utils.translation import ugettext_lazy as _
@@ -11,6 +12,9 @@ from mongoengine import ReferenceField as MongoReferenceField
 from mongoengine.fields import (
     IntField, SequenceField)
 
+from django.core.cache import cache
+from mongotools.utils import raw_cursor, label_from_son, get_queryset_cache_key
+
 BLANK_CHOICE_DASH = [("", "---------")]
 
 class MongoChoiceIterator(object):
@@ -22,15 +26,45 @@ class MongoChoiceIterator(object):
         if self.field.empty_label is not None:
             yield (u"", self.field.empty_label)
         
-        for obj in self.queryset.all():
-            yield self.choice(obj)
+        for choice in self.get_choices():
+            yield choice
 
     def __len__(self):
-        return len(self.queryset)
+        if self.field.choices_cache_timeout is not None:
+            return len(self.get_choices())
+        return self.queryset.count()
 
     def choice(self, obj):
         return (self.field.prepare_value(obj), self.field.label_from_instance(obj))
 
+    def get_choices(self):
+        """
+        Returns the choices, from the shared choice cache if the field has a
+        `choices_cache_timeout`.
+        """
+        timeout = self.field.choices_cache_timeout
+        if timeout is None:
+            return self.iter_choices()
+
+        key = get_queryset_cache_key('choices', self.queryset,
+                                     self.field.__class__.__name__,
+                                     *(self.field.label_fields or ()))
+        choices = cache.get(key)
+        if choices is None:
+            choices = list(self.iter_choices())
+            cache.set(key, choices, timeout)
+        return choices
+
+    def iter_choices(self):
+        if not self.field.label_fields:
+            for obj in self.queryset.all():
+                yield self.choice(obj)
+            return
+
+        # only the pk and the label fields are loaded, as plain dicts
+        for son in raw_cursor(self.queryset, self.field.label_fields):
+            yield (son['_id'], self.field.label_from_son(son))
+
 
 class MongoCharField(forms.CharField):
     def to_python(self, value):
@@ -42,10 +76,16 @@ class ReferenceField(forms.TypedChoiceField):
     """
     Reference field for mongo forms. Inspired by `django.forms.models.ModelChoiceField`.
     """
-    def __init__(self, queryset, empty_label=u"---------",
-                 *aargs, **kwaargs):
+    # documents resolved by MongoForm before the fields are cleaned,
+    # mapped by pk; None when clean must look the document up by itself
+    prefetched = None
+
+    def __init__(self, queryset, empty_label=u"---------", label_fields=None,
+                 choices_cache_timeout=None, *aargs, **kwaargs):
         
         super(ReferenceField, self).__init__(*aargs, **kwaargs)
+        self.label_fields = label_fields
+        self.choices_cache_timeout = choices_cache_timeout
         self.queryset = queryset
         self.empty_label = empty_label
         
@@ -84,6 +124,61 @@ class ReferenceField(forms.TypedChoiceField):
         """
         return smart_unicode(obj)
 
+    def label_from_son(self, son):
+        """
+        Builds the label of a choice from the raw stored document, when
+        `label_fields` is given. Joins the values of the label fields by
+        default.
+        """
+        return label_from_son(self.queryset._document, son, self.label_fields)
+
+    def to_pk(self, value):
+        if self.coerce == int:
+            return int(value)
+        return ObjectId(value)
+
+    def valid_value(self, value):
+        # the lookup in clean already checks the value against the
+        # queryset, walking every choice here would load the collection
+        return True
+
+    def selected_choices(self, values):
+        """
+        Returns the choices for the given pks only, for widgets that do not
+        render every choice of the queryset.
+        """
+        pks = []
+        for value in values:
+            try:
+                pks.append(self.to_pk(value))
+            except (TypeError, ValueError, InvalidId):
+                continue
+
+        if not pks:
+            return []
+
+        queryset = self.queryset.clone().filter(pk__in=pks)
+        if self.label_fields:
+            return [(son['_id'], self.label_from_son(son)) for son in
+                    raw_cursor(queryset, self.label_fields)]
+
+        iterator = MongoChoiceIterator(self)
+        return [iterator.choice(obj) for obj in queryset]
+
+    def get_object(self, pk):
+        """
+        Returns the referenced document, from the documents prefetched by
+        the form if there are any.
+        """
+        if self.prefetched is not None:
+            try:
+                return self.prefetched[self.to_pk(pk)]
+            except KeyError:
+                raise self.queryset._document.DoesNotExist()
+
+        queryset = self.queryset.clone()
+        return queryset.get(pk=pk)
+
     def clean(self, oid):
         if oid in EMPTY_VALUES and not self.required:
             return None
@@ -93,9 +188,7 @@ class ReferenceField(forms.TypedChoiceField):
                 oid = ObjectId(oid)
 
             oid = super(ReferenceField, self).clean(oid)
-
-            queryset = self.queryset.clone()
-            obj = queryset.get(pk=oid)
+            obj = self.get_object(oid)
         except (TypeError, InvalidId, self.queryset._document.DoesNotExist):
             raise forms.ValidationError(self.error_messages['invalid_choice'] % {'value': oid})
         return obj
@@ -111,9 +204,14 @@ class DocumentMultipleChoiceField(ReferenceField):
         'invalid_pk_value': _(u'"%s" is not a valid value for a primary key.')
     }
 
-    def __init__(self, queryset, *args, **kwargs):
+    def __init__(self, queryset, lazy=False, *args, **kwargs):
+        # lazy fields clean to DBRefs instead of documents
+        self.lazy = lazy
         super(DocumentMultipleChoiceField, self).__init__(queryset, empty_label=None, *args, **kwargs)  
 
+    def make_reference(self, pk):
+        return DBRef(self.queryset._document._meta['collection'], pk)
+
     def clean(self, value):
         if self.required and not value:
             raise forms.ValidationError(self.error_messages['required'])
@@ -121,25 +219,39 @@ class DocumentMultipleChoiceField(ReferenceField):
             return []
         if not isinstance(value, (list, tuple)):
             raise forms.ValidationError(self.error_messages['list'])
-        key = 'pk'
         
         filter_ids = []
         for pk in value:
             try:
                 oid = ObjectId(pk)
-                filter_ids.append(oid)
             except InvalidId:
                 raise forms.ValidationError(self.error_messages['invalid_pk_value'] % pk)
-        qs = self.queryset.clone()
-        qs = qs.filter(**{'%s__in' % key: filter_ids})
-        pks = set([force_unicode(getattr(o, key)) for o in qs])
+            if oid not in filter_ids:
+                filter_ids.append(oid)
+
+        # a single query validates the values; lazy fields only load the ids
+        if self.prefetched is not None:
+            objects = self.prefetched
+        elif self.lazy:
+            id_field = self.queryset._document._meta['id_field']
+            qs = self.queryset.clone().filter(pk__in=filter_ids)
+            objects = dict([(son['_id'], son['_id'])
+                            for son in raw_cursor(qs, [id_field])])
+        else:
+            qs = self.queryset.clone().filter(pk__in=filter_ids)
+            objects = dict([(obj.pk, obj) for obj in qs])
+
+        pks = set([force_unicode(pk) for pk in objects])
         for val in value:
             if force_unicode(val) not in pks:
                 raise forms.ValidationError(self.error_messages['invalid_choice'] % val)
         # Since this overrides the inherited ModelChoiceField.clean
         # we run custom validators here
         self.run_validators(value)
-        return list(qs)
+
+        if self.lazy:
+            return [self.make_reference(object_id) for object_id in filter_ids]
+        return [objects[object_id] for object_id in filter_ids]
 
     def prepare_value(self, value):
         if hasattr(value, '__iter__') and not hasattr(value, '_meta'):
@@ -147,32 +259,73 @@ class DocumentMultipleChoiceField(ReferenceField):
         return super(DocumentMultipleChoiceField, self).prepare_value(value)
 
 
+# generators resolved for each (generator class, field class)
+_resolved_generators = {}
+
+
 class MongoFormFieldGenerator(object):
     """This is singleton class generates Django form-fields for mongoengine-fields."""
     
     _instance = None
     def __new__(cls, *args, **kwargs):
-        if not cls._instance:
+        # each generator subclass gets its own instance
+        if cls.__dict__.get('_instance') is None:
             cls._instance = super(MongoFormFieldGenerator, cls).__new__(
                 cls, *args, **kwargs)
         return cls._instance
 
-    def generate(self, field, **kwargs):
-        """Tries to lookup a matching formfield generator (lowercase 
-        field-classname) and raises a NotImplementedError of no generator
-        can be found.
+    @classmethod
+    def register(cls, field_cls, factory):
+        """Registers `factory(field, **kwargs)` to build the form-fields of
+        the mongoengine-field class `field_cls` and its subclasses.
         """
-        if hasattr(self, 'generate_%s' % field.__class__.__name__.lower()):
-            return getattr(self, 'generate_%s' % \
-                field.__class__.__name__.lower())(field, **kwargs)
-        else:
-            for cls in field.__class__.__bases__:
-                if hasattr(self, 'generate_%s' % cls.__name__.lower()):
-                    return getattr(self, 'generate_%s' % \
-                                       cls.__name__.lower())(field, **kwargs)
+        if '_registry' not in cls.__dict__:
+            cls._registry = {}
+        cls._registry[field_cls] = factory
+        _resolved_generators.clear()
+
+    def _lookup_registry(self, field_cls):
+        for klass in type(self).__mro__:
+            registry = klass.__dict__.get('_registry', {})
+            if field_cls in registry:
+                factory = registry[field_cls]
+                return lambda generator, field, **kwargs: factory(field, **kwargs)
+        return None
+
+    def get_generator(self, field_cls):
+        """Walks the mro of the field class once and returns the registered
+        factory or the `generate_<classname>` method of the closest class.
+        The result is cached per field class.
+        """
+        key = (type(self), field_cls)
+        try:
+            return _resolved_generators[key]
+        except KeyError:
+            pass
+
+        generator = None
+        for cls in field_cls.__mro__:
+            generator = self._lookup_registry(cls)
+            if generator is None:
+                generator = getattr(type(self),
+                                    'generate_%s' % cls.__name__.lower(), None)
+            if generator is not None:
+                break
+
+        _resolved_generators[key] = generator
+        return generator
 
+    def generate(self, field, **kwargs):
+        """Tries to lookup a matching formfield generator (registered for
+        the field class or one of its bases, or a lowercase field-classname
+        method) and raises a NotImplementedError of no generator can be
+        found.
+        """
+        generator = self.get_generator(field.__class__)
+        if generator is None:
             raise NotImplementedError('%s is not supported by MongoForm' % \
                                           field.__class__.__name__)
+        return generator(self, field, **kwargs)
                 
     def get_field_choices(self, field, include_blank=True,
                           blank_choice=BLANK_CHOICE_DASH):
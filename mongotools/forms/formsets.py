@@ -0,0 +1,208 @@
+from bson.objectid import ObjectId
+from django import forms
+from django.forms.forms import NON_FIELD_ERRORS
+from django.forms.formsets import BaseFormSet, formset_factory
+from django.utils.translation import ugettext_lazy as _
+from mongoengine.base import ValidationError
+from pymongo.errors import BulkWriteError
+
+from mongotools.utils import invalidate_document_cache
+
+# name of the hidden field holding the pk of each initial form
+PK_FIELD = 'pk'
+
+
+def missing_document(value):
+    raise forms.ValidationError(_(u'This document does not exist anymore.'))
+
+
+class MongoFormSet(BaseFormSet):
+    """
+    A formset of MongoForms editing the documents of `queryset`, by default
+    all the documents of the form's document.
+
+    The documents are loaded with one query, an `$in` over the posted pks
+    when the formset is bound. `save` writes all the created, changed and
+    deleted documents with one unordered bulk operation; rows the server
+    rejects get the error as a non field error and are left out of the
+    returned documents, so check `is_valid()` again after saving.
+    """
+    document = None
+
+    def __init__(self, data=None, files=None, auto_id='id_%s', prefix=None,
+                 queryset=None, **kwargs):
+        self.queryset = queryset
+        self._instances = None
+        # the forms are built by BaseFormSet.__init__
+        super(MongoFormSet, self).__init__(data, files, auto_id, prefix,
+                                           **kwargs)
+
+    def get_queryset(self):
+        if self.queryset is not None:
+            return self.queryset.clone()
+        return self.document.objects
+
+    def get_instances(self):
+        """
+        Returns the documents of the initial forms, in order, None for
+        posted pks that do not match a document.
+        """
+        if self._instances is not None:
+            return self._instances
+
+        queryset = self.get_queryset()
+        if not self.is_bound:
+            self._instances = list(queryset)
+            return self._instances
+
+        pks = [self.data.get(self.add_prefix(i) + '-' + PK_FIELD)
+               for i in range(self.initial_form_count())]
+        id_field = self.document._fields[self.document._meta['id_field']]
+        ids = []
+        for pk in pks:
+            if not pk:
+                continue
+            try:
+                ids.append(id_field.to_mongo(pk))
+            except (ValidationError, TypeError, ValueError):
+                # the form of a malformed pk is invalid, see add_fields
+                continue
+
+        objects = {}
+        if ids:
+            objects = dict([(unicode(obj.pk), obj) for obj in
+                            queryset.filter(pk__in=ids)])
+        self._instances = [objects.get(pk) for pk in pks]
+        return self._instances
+
+    def initial_form_count(self):
+        if not self.is_bound:
+            return len(self.get_instances())
+        return super(MongoFormSet, self).initial_form_count()
+
+    def _construct_form(self, i, **kwargs):
+        if i < self.initial_form_count():
+            kwargs['instance'] = self.get_instances()[i]
+        return super(MongoFormSet, self)._construct_form(i, **kwargs)
+
+    def add_fields(self, form, index):
+        super(MongoFormSet, self).add_fields(form, index)
+        form.fields[PK_FIELD] = forms.CharField(widget=forms.HiddenInput,
+                                                required=False)
+
+        # an initial row whose document is gone must not become a new one
+        if self.is_bound and index < self.initial_form_count() and \
+           self.get_instances()[index] is None:
+            form.fields[PK_FIELD] = forms.CharField(
+                widget=forms.HiddenInput, validators=[missing_document])
+        if not form.instance._adding:
+            form.initial[PK_FIELD] = unicode(form.instance.pk)
+
+    def _should_delete(self, form):
+        # invalid forms marked for deletion have no cleaned_data
+        if not self.can_delete:
+            return False
+        return form.fields['DELETE'].clean(form._raw_value('DELETE'))
+
+    def save(self, commit=True):
+        """
+        Saves the changed forms and deletes the forms marked for deletion,
+        returns the saved documents. Without `commit` the documents are
+        returned unsaved and nothing is deleted, see MongoForm.save for the
+        files they replace.
+        """
+        collection = self.document.objects._collection
+        id_field = self.document._meta['id_field']
+        bulk = collection.initialize_unordered_bulk_op()
+        # the form of each bulk operation, by index
+        operations = []
+        saved, self.deleted_objects = [], []
+
+        for i, form in enumerate(self.forms):
+            initial = i < self.initial_form_count()
+            if initial and form.instance._adding:
+                # the document of the row is gone, the form is invalid
+                continue
+
+            if self._should_delete(form):
+                if not initial:
+                    continue
+                self.deleted_objects.append(form.instance)
+                if not commit:
+                    continue
+                if form.instance._meta.get('delete_rules'):
+                    # delete rules are applied by mongoengine
+                    form.instance.delete()
+                else:
+                    bulk.find({'_id': form.instance.pk}).remove_one()
+                    operations.append(form)
+                continue
+
+            if not form.has_changed():
+                continue
+
+            instance = form.save(commit=False)
+            if not commit:
+                saved.append(instance)
+                continue
+
+            try:
+                instance.validate()
+            except ValidationError, e:
+                form._errors[NON_FIELD_ERRORS] = form.error_class([unicode(e)])
+                form.discard_files()
+                continue
+
+            son = instance.to_mongo()
+            if initial:
+                bulk.find({'_id': instance.pk}).replace_one(son)
+            else:
+                if son.get('_id') is None:
+                    son['_id'] = ObjectId()
+                    setattr(instance, id_field, son['_id'])
+                bulk.insert(son)
+            operations.append(form)
+            saved.append(instance)
+
+        if not commit or not operations:
+            return saved
+
+        failed = set()
+        try:
+            bulk.execute()
+        except BulkWriteError, e:
+            for error in e.details.get('writeErrors', []):
+                form = operations[error['index']]
+                failed.add(form)
+                form._errors[NON_FIELD_ERRORS] = form.error_class(
+                    [error.get('errmsg', u'')])
+                for objects in (saved, self.deleted_objects):
+                    if form.instance in objects:
+                        objects.remove(form.instance)
+
+        # files replaced by written rows can go, those of failed rows stay
+        for form in operations:
+            if form in failed:
+                form.discard_files()
+            else:
+                form.release_files()
+
+        self.invalidate(operations)
+        return saved
+
+    def invalidate(self, forms):
+        # mongotools.views imports the forms package, import it lazily
+        from mongotools.views.cache import invalidate_object
+
+        for form in forms:
+            invalidate_object(self.document, form.instance.pk)
+        invalidate_document_cache(self.document)
+
+
+def mongoformset_factory(form, formset=MongoFormSet, extra=1,
+                         can_order=False, can_delete=False, max_num=None):
+    """returns a MongoFormSet class for the given MongoForm class.."""
+    FormSet = formset_factory(form, formset, extra=extra, can_order=can_order,
+                              can_delete=can_delete, max_num=max_num)
+    FormSet.document = form._meta.document
+    return FormSet
@@ -0,0 +1,108 @@
+import hashlib
+
+import gridfs
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler
+from mongoengine.connection import _get_db
+
+from mongotools.forms.utils import _get_unique_filename, acquire_file, release_file
+
+
+class GridFSUploadedFile(UploadedFile):
+    """
+    A file already stored in GridFS by GridFSUploadHandler. The content is
+    only read back from GridFS if something opens the file.
+    """
+    def __init__(self, grid_id, name=None, content_type=None, size=None,
+                 charset=None, sha1=None):
+        super(GridFSUploadedFile, self).__init__(None, name, content_type,
+                                                 size, charset)
+        self.grid_id = grid_id
+        self.sha1 = sha1
+
+    def _get_file(self):
+        if self._file is None:
+            self._file = gridfs.GridFS(_get_db()).get(self.grid_id)
+        return self._file
+
+    def _set_file(self, file):
+        self._file = file
+
+    file = property(_get_file, _set_file)
+
+
+class GridFSUploadHandler(FileUploadHandler):
+    """
+    Writes uploaded files straight into GridFS chunk by chunk, as Django
+    receives them, without keeping them in memory or in a temporary file.
+    MongoForm.save then only attaches the stored file to the document.
+
+    Subclass to change `chunk_size` (also used as the GridFS chunk size) or
+    the `filename_strategy` (see mongotools.forms.utils). With
+    `deduplicate`, an upload whose content is already stored is dropped
+    once complete and the stored file is referenced instead.
+    """
+    chunk_size = 256 * 1024
+    filename_strategy = 'counter'
+    deduplicate = False
+
+    def new_file(self, field_name, file_name, content_type, content_length,
+                 charset=None):
+        super(GridFSUploadHandler, self).new_file(
+            field_name, file_name, content_type, content_length, charset)
+
+        fs = gridfs.GridFS(_get_db())
+        self.grid_in = fs.new_file(content_type=content_type,
+                                   chunkSize=self.chunk_size)
+        self.sha1 = hashlib.sha1()
+
+    def receive_data_chunk(self, raw_data, start):
+        self.grid_in.write(raw_data)
+        self.sha1.update(raw_data)
+        # the chunk is stored, later handlers do not get it
+
+    def file_complete(self, file_size):
+        sha1 = self.sha1.hexdigest()
+
+        if self.deduplicate:
+            grid_id = acquire_file(sha1)
+            if grid_id is not None:
+                # the digest is only known now, drop the copy just written
+                self.grid_in.close()
+                gridfs.GridFS(_get_db()).delete(self.grid_in._id)
+                return GridFSUploadedFile(grid_id, self.file_name,
+                                          self.content_type, file_size,
+                                          self.charset, sha1)
+
+            self.grid_in.sha1 = sha1
+            self.grid_in.refs = 1
+
+        uploaded = GridFSUploadedFile(self.grid_in._id, self.file_name,
+                                      self.content_type, file_size,
+                                      self.charset, sha1)
+
+        # the name is given last, so strategies may use the content hash
+        self.grid_in.filename = _get_unique_filename(
+            self.file_name, self.filename_strategy, uploaded)
+        self.grid_in.close()
+
+        uploaded.name = self.grid_in.filename
+        return uploaded
+
+    def upload_interrupted(self):
+        # drop the chunks written so far
+        grid_in = getattr(self, 'grid_in', None)
+        if grid_in is not None and not grid_in.closed:
+            grid_in.close()
+            gridfs.GridFS(_get_db()).delete(grid_in._id)
+
+
+def discard_uploads(files):
+    """
+    Deletes the files streamed into GridFS for a request whose form was
+    rejected, as no document will ever reference them.
+    """
+    for field_name, uploads in files.lists():
+        for uploaded in uploads:
+            if getattr(uploaded, 'grid_id', None) is not None:
+                release_file(uploaded.grid_id)
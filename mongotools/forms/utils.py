@@ -1,10 +1,14 @@
 import os
-import itertools
+import re
+import uuid
+import hashlib
 import gridfs
 
+from bson.dbref import DBRef
+
 from django import forms
 from mongoengine.base import ValidationError
-from mongoengine.fields import EmbeddedDocumentField, ListField, ReferenceField
+from mongoengine.fields import EmbeddedDocumentField, ListField, ReferenceField, FileField
 from mongoengine.connection import _get_db
 
 from fields import MongoFormFieldGenerator
@@ -62,20 +66,198 @@ def iter_valid_fields(meta):
 
         yield (field_name, field)
 
-def _get_unique_filename(name):
-    fs = gridfs.GridFS(_get_db())
+# kinds of fields in a compiled field plan
+PLAIN = 'plain'
+REFERENCE = 'reference'
+REFERENCE_LIST = 'reference_list'
+FILE = 'file'
+
+def get_field_kind(field):
+    if isinstance(field, FileField):
+        return FILE
+    if isinstance(field, ReferenceField):
+        return REFERENCE
+    if isinstance(field, ListField) and isinstance(field.field, ReferenceField):
+        return REFERENCE_LIST
+    return PLAIN
+
+def compile_field_plan(meta):
+    """
+    Walks the valid fields once and returns them as an immutable tuple of
+    `(field_name, field, kind)`, for the per-request form code to iterate.
+    """
+    return tuple([(field_name, field, get_field_kind(field))
+                  for field_name, field in iter_valid_fields(meta)])
+
+def reference_id(value):
+    """returns the id of a stored reference without dereferencing it.."""
+    if isinstance(value, DBRef):
+        return value.id
+    if hasattr(value, '_meta'):
+        return value.pk
+    return value
+
+# collection holding one upload counter per filename
+FILENAME_COUNTERS = 'mongotools.filenames'
+
+def _suffixed_filename(name, count):
+    """the n-th upload of name.ext is named name_<n - 1>.ext.."""
+    if count <= 1:
+        return name
     file_root, file_ext = os.path.splitext(name)
-    count = itertools.count(1)
-    while fs.exists(filename=name):
-        # file_ext includes the dot.
-        name = os.path.join("%s_%s%s" % (file_root, count.next(), file_ext))
-    return name
+    # file_ext includes the dot.
+    return "%s_%s%s" % (file_root, count - 1, file_ext)
+
+def _max_suffix(name):
+    """
+    returns the highest upload count among the stored files named after
+    name, or 0 if there is none, with a single anchored-regex query..
+    """
+    file_root, file_ext = os.path.splitext(name)
+    regex = re.compile(u'^%s(?:_(\\d+))?%s$' % (re.escape(file_root),
+                                                 re.escape(file_ext)))
+    count = 0
+    files = _get_db()['fs.files']
+    for son in files.find({'filename': regex}, fields=['filename']):
+        match = regex.match(son['filename'])
+        if match:
+            count = max(count, int(match.group(1) or 0) + 1)
+    return count
+
+def counter_filename(fs, name, file):
+    """
+    Allocates the name with an atomic per-filename counter, which never
+    hands out the same name twice. A new counter starts after the files
+    already stored under that name, and names taken by files stored under
+    another name (an upload named "a_1.jpg" for "a.jpg") are skipped.
+    """
+    counters = _get_db()[FILENAME_COUNTERS]
+    files = _get_db()['fs.files']
+    count = counters.find_and_modify({'_id': name}, {'$inc': {'n': 1}},
+                                     upsert=True, new=True)['n']
+
+    if count == 1:
+        existing = _max_suffix(name)
+        if existing:
+            count = counters.find_and_modify(
+                {'_id': name}, {'$inc': {'n': existing}}, new=True)['n']
+
+    filename = _suffixed_filename(name, count)
+    while files.find_one({'filename': filename}, fields=['_id']) is not None:
+        count = counters.find_and_modify({'_id': name}, {'$inc': {'n': 1}},
+                                         new=True)['n']
+        filename = _suffixed_filename(name, count)
+    return filename
+
+def regex_filename(fs, name, file):
+    """
+    Allocates the name after the highest suffix found with one regex query.
+    Concurrent uploads of the same name may still pick the same name.
+    """
+    return _suffixed_filename(name, _max_suffix(name) + 1)
+
+def uuid_filename(fs, name, file):
+    """names the file after a random uuid, keeping its extension.."""
+    return '%s%s' % (uuid.uuid4().hex, os.path.splitext(name)[1])
+
+def file_sha1(file):
+    """returns the sha1 hexdigest of an uploaded file.."""
+    # streamed uploads come with the digest computed while storing them
+    hexdigest = getattr(file, 'sha1', None)
+    if hexdigest is None:
+        digest = hashlib.sha1()
+        for chunk in file.chunks():
+            digest.update(chunk)
+        hexdigest = digest.hexdigest()
+    return hexdigest
 
-def save_file(instance, field_name, file):
+def hash_filename(fs, name, file):
+    """names the file after the sha1 of its content, keeping its extension.."""
+    return '%s%s' % (file_sha1(file), os.path.splitext(name)[1])
+
+FILENAME_STRATEGIES = {
+    'counter': counter_filename,
+    'regex': regex_filename,
+    'uuid': uuid_filename,
+    'hash': hash_filename,
+}
+
+def _get_unique_filename(name, strategy='counter', file=None):
+    """
+    returns a filename not used by any stored file yet. strategy is the
+    name of one of FILENAME_STRATEGIES or a callable taking the GridFS
+    instance, the wanted name and the uploaded file..
+    """
+    fs = gridfs.GridFS(_get_db())
+    if not callable(strategy):
+        strategy = FILENAME_STRATEGIES[strategy]
+    return strategy(fs, name, file)
+
+def acquire_file(sha1):
+    """
+    Content-addressed files are stored once, with their `sha1` and a
+    `refs` count on the GridFS file document. If a file with that digest
+    is stored, takes one more reference to it and returns its id, else
+    returns None.
+
+    Two concurrent first uploads of the same content may both store it,
+    which only costs the space deduplication would have saved.
+    """
+    files = _get_db()['fs.files']
+    files.ensure_index('sha1', sparse=True)
+    son = files.find_and_modify({'sha1': sha1, 'refs': {'$gt': 0}},
+                                {'$inc': {'refs': 1}}, fields=['_id'],
+                                new=True)
+    return son and son['_id']
+
+def release_file(grid_id):
+    """
+    Drops one reference to a stored file and deletes it when none is left.
+    Files stored without reference counting are deleted right away.
+    """
+    if grid_id is None:
+        return
+
+    files = _get_db()['fs.files']
+    son = files.find_and_modify({'_id': grid_id, 'refs': {'$exists': True}},
+                                {'$inc': {'refs': -1}}, fields=['refs'],
+                                new=True)
+    if son is None or son['refs'] <= 0:
+        gridfs.GridFS(_get_db()).delete(grid_id)
+
+def save_file(instance, field_name, file, strategy='counter',
+              deduplicate=False):
+    """
+    stores the file in GridFS and points the FileField at it; the previous
+    file is left to the caller, to release once the instance is written..
+    """
     field = getattr(instance, field_name)
+
+    extra = {}
+    if deduplicate:
+        sha1 = file_sha1(file)
+        grid_id = acquire_file(sha1)
+        if grid_id is not None:
+            # the same content is stored already, nothing to write
+            field.grid_id = grid_id
+            return field
+        extra = {'sha1': sha1, 'refs': 1}
     
-    filename = _get_unique_filename(file.name)
+    filename = _get_unique_filename(file.name, strategy, file)
     file.file.seek(0)
     
-    field.replace(file, content_type=file.content_type, filename=filename)
+    fs = gridfs.GridFS(_get_db())
+    grid_id = fs.put(file, content_type=file.content_type, filename=filename,
+                     **extra)
+    field.grid_id = grid_id
+    return field
+
+def attach_file(instance, field_name, file):
+    """
+    points the FileField at a file already stored in GridFS, see
+    mongotools.forms.uploadhandler; like save_file it leaves the previous
+    file to the caller..
+    """
+    field = getattr(instance, field_name)
+    field.grid_id = file.grid_id
     return field
@@ -0,0 +1,66 @@
+from itertools import chain
+
+from django import forms
+from django.core.validators import EMPTY_VALUES
+from django.utils.encoding import force_unicode
+
+
+class AutocompleteWidgetMixin(object):
+    """
+    Renders a select with only the currently selected choices as options.
+    The other choices are looked up by the client against the search view
+    at `url` (see `mongotools.views.ReferenceSearchView`), so the page size
+    does not grow with the referenced collection.
+
+    The select gets the `mongotools-autocomplete` class and the
+    `data-autocomplete-url` and `data-autocomplete-min-length` attributes
+    to hook an autocomplete script into.
+    """
+    def __init__(self, url, min_length=1, attrs=None, choices=()):
+        super(AutocompleteWidgetMixin, self).__init__(attrs, choices)
+        self.url = url
+        self.min_length = min_length
+
+    def get_url(self):
+        # url may be a callable, to delay the url resolving
+        if callable(self.url):
+            return self.url()
+        return self.url
+
+    def build_attrs(self, extra_attrs=None, **kwargs):
+        attrs = super(AutocompleteWidgetMixin, self).build_attrs(
+            extra_attrs, **kwargs)
+        attrs['class'] = (u'%s mongotools-autocomplete' %
+                          attrs.get('class', u'')).strip()
+        attrs['data-autocomplete-url'] = self.get_url()
+        attrs['data-autocomplete-min-length'] = self.min_length
+        return attrs
+
+    def render_options(self, choices, selected_choices):
+        field = getattr(self.choices, 'field', None)
+        if field is None:
+            return super(AutocompleteWidgetMixin, self).render_options(
+                choices, selected_choices)
+
+        values = []
+        for value in selected_choices:
+            if hasattr(value, '_meta'):
+                value = value.pk
+            if value not in EMPTY_VALUES:
+                values.append(value)
+
+        options = field.selected_choices(values)
+        if field.empty_label is not None:
+            options.insert(0, (u'', field.empty_label))
+
+        selected = set([force_unicode(v) for v in values])
+        return u'\n'.join([self.render_option(selected, option_value, label)
+                           for option_value, label in chain(options, choices)])
+
+
+class AutocompleteSelect(AutocompleteWidgetMixin, forms.Select):
+    pass
+
+
+class AutocompleteSelectMultiple(AutocompleteWidgetMixin, forms.SelectMultiple):
+    pass
@@ -0,0 +1,234 @@
+from django import forms
+from django.http import HttpResponse
+from django.test.client import RequestFactory
+from django.utils import unittest
+from mongoengine import Document, StringField, IntField, ReferenceField, \
+    connect
+from pymongo.errors import ConnectionFailure
+
+from mongotools.forms import MongoForm
+from mongotools.forms.formsets import mongoformset_factory
+from mongotools.views import BaseDetailView, BulkDeleteView, ExportView
+from mongotools.views.cache import invalidate_object
+from mongotools.views.pagination import KeysetPaginator
+
+
+class Author(Document):
+    name = StringField()
+
+
+class Book(Document):
+    title = StringField()
+    author = ReferenceField(Author)
+    editor = ReferenceField(Author)
+
+
+class Note(Document):
+    text = StringField()
+    rank = IntField()
+
+
+class BookForm(MongoForm):
+    class Meta:
+        document = Book
+
+
+class NoteForm(MongoForm):
+    class Meta:
+        document = Note
+
+
+class MongoTestCase(unittest.TestCase):
+    """skips the tests when there is no MongoDB server to run them.."""
+    @classmethod
+    def setUpClass(cls):
+        try:
+            connect('mongotools_test')
+        except ConnectionFailure:
+            raise unittest.SkipTest(u'no MongoDB server running')
+
+    def tearDown(self):
+        for document in (Author, Book, Note):
+            document.drop_collection()
+
+
+class ReferencePrefetchTest(MongoTestCase):
+    def setUp(self):
+        self.author = Author(name=u'author')
+        self.author.save()
+        self.editor = Author(name=u'editor')
+        self.editor.save()
+
+        self.queries = []
+        collection = Author._get_collection()
+        find = collection.find
+
+        def counting_find(*args, **kwargs):
+            self.queries.append(args)
+            return find(*args, **kwargs)
+        collection.find = counting_find
+
+    def tearDown(self):
+        del Author._get_collection().find
+        super(ReferencePrefetchTest, self).tearDown()
+
+    def test_references_of_one_collection_share_a_query(self):
+        form = BookForm({'title': u'title', 'author': str(self.author.pk),
+                         'editor': str(self.editor.pk)})
+
+        self.assertTrue(form.is_valid())
+        self.assertEqual(form.cleaned_data['author'], self.author)
+        self.assertEqual(form.cleaned_data['editor'], self.editor)
+        self.assertEqual(len(self.queries), 1)
+
+    def test_missing_reference_is_invalid(self):
+        form = BookForm({'title': u'title', 'author': str(self.author.pk),
+                         'editor': '0' * 24})
+
+        self.assertFalse(form.is_valid())
+        self.assertEqual(form.errors.keys(), ['editor'])
+        self.assertEqual(len(self.queries), 1)
+
+
+class KeysetPaginatorTest(MongoTestCase):
+    def setUp(self):
+        for rank in (3, None, 1, 2, None, 5):
+            Note(rank=rank).save()
+
+    def walk(self, ordering):
+        paginator = KeysetPaginator(Note.objects, 2, ordering=ordering)
+        page = paginator.page(None)
+        forward = [note.rank for note in page]
+        while page.has_next():
+            page = paginator.page(page.next_page_token())
+            forward.extend([note.rank for note in page])
+
+        backward = [note.rank for note in page]
+        while page.has_previous():
+            page = paginator.page(page.previous_page_token())
+            backward[:0] = [note.rank for note in page]
+        return forward, backward
+
+    def test_pages_cover_documents_without_key(self):
+        for ordering in ('rank', '-rank'):
+            forward, backward = self.walk(ordering)
+            self.assertEqual(len(forward), 6)
+            self.assertEqual(forward, backward)
+            self.assertEqual(forward.count(None), 2)
+
+
+class NoteExportView(ExportView):
+    document = Note
+    export_fields = ('text', 'rank')
+    rows_per_chunk = 2
+
+
+class ExportViewTest(MongoTestCase):
+    def test_rows_are_streamed_in_chunks(self):
+        for rank in range(5):
+            Note(text=u'note %s' % rank, rank=rank).save()
+
+        response = NoteExportView.as_view()(RequestFactory().get('/'))
+        chunks = list(response._container)
+
+        self.assertEqual(len(chunks), 3)
+        lines = ''.join(chunks).splitlines()
+        self.assertEqual(lines[0], 'text,rank')
+        self.assertEqual(sorted(lines[1:]),
+                         ['note %s,%s' % (rank, rank) for rank in range(5)])
+
+
+class NoteFilterForm(forms.Form):
+    text = forms.CharField(required=False)
+
+
+class NoteDeleteView(BulkDeleteView):
+    document = Note
+    filter_form_class = NoteFilterForm
+    success_url = '/'
+
+
+class BulkDeleteViewTest(MongoTestCase):
+    def test_deletes_posted_pks_only(self):
+        notes = [Note(rank=rank) for rank in range(3)]
+        for note in notes:
+            note.save()
+
+        request = RequestFactory().post(
+            '/', {'pk': [str(notes[0].pk), str(notes[1].pk)]})
+        response = NoteDeleteView.as_view()(request)
+
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual([note.pk for note in Note.objects], [notes[2].pk])
+
+    def test_malformed_pk_is_bad_request(self):
+        Note(rank=1).save()
+
+        request = RequestFactory().post('/', {'pk': ['malformed']})
+        response = NoteDeleteView.as_view()(request)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Note.objects.count(), 1)
+
+    def test_empty_filter_is_bad_request(self):
+        Note(text=u'note').save()
+
+        request = RequestFactory().post('/', {'text': u''})
+        response = NoteDeleteView.as_view()(request)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Note.objects.count(), 1)
+
+    def test_filter_picks_matching_documents(self):
+        Note(text=u'keep').save()
+        Note(text=u'drop').save()
+
+        request = RequestFactory().post('/', {'text': u'drop'})
+        response = NoteDeleteView.as_view()(request)
+
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual([note.text for note in Note.objects], [u'keep'])
+
+
+class MongoFormSetTest(MongoTestCase):
+    def test_row_of_deleted_document_is_invalid(self):
+        note = Note(text=u'note')
+        note.save()
+        pk = str(note.pk)
+        note.delete()
+
+        FormSet = mongoformset_factory(NoteForm, extra=0)
+        formset = FormSet({'form-TOTAL_FORMS': '1',
+                           'form-INITIAL_FORMS': '1',
+                           'form-0-pk': pk, 'form-0-text': u'changed'})
+
+        self.assertFalse(formset.is_valid())
+        self.assertEqual(formset.forms[0].errors.keys(), ['pk'])
+        self.assertEqual(Note.objects.count(), 0)
+
+
+class CachedNoteView(BaseDetailView):
+    document = Note
+    cache_objects = True
+
+    def render_to_response(self, context):
+        return HttpResponse(context['object'].text)
+
+
+class ObjectCacheTest(MongoTestCase):
+    def get(self, note):
+        request = RequestFactory().get('/')
+        return CachedNoteView.as_view()(request, pk=str(note.pk)).content
+
+    def test_cached_object_is_served_until_invalidated(self):
+        note = Note(text=u'first')
+        note.save()
+        self.assertEqual(self.get(note), 'first')
+
+        # written without mongoengine, the cache is not told
+        Note._get_collection().update({'_id': note.pk},
+                                      {'$set': {'text': u'second'}})
+        self.assertEqual(self.get(note), 'first')
+
+        invalidate_object(Note, note.pk)
+        self.assertEqual(self.get(note), 'second')
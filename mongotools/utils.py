@@ -0,0 +1,146 @@
+import time
+import uuid
+import decimal
+import hashlib
+import datetime
+
+from bson import BSON
+from bson.dbref import DBRef
+from bson.objectid import ObjectId
+from django.core.cache import cache
+from django.utils import simplejson
+from django.utils.encoding import smart_unicode
+
+try:
+    from bson.decimal128 import Decimal128
+except ImportError:
+    # pymongo releases before 3.4
+    Decimal128 = None
+
+GENERATION_KEY = 'mongotools:generation:%s'
+GENERATION_TIMEOUT = 60 * 60 * 24 * 30
+
+
+def raw_cursor(queryset, fields=None):
+    """
+    Returns the pymongo cursor behind a queryset, which yields plain dicts
+    instead of documents. Filters, ordering, skip and limit of the queryset
+    are kept; `fields` restricts the loaded fields.
+    """
+    queryset = queryset.clone()
+    if fields is not None:
+        queryset = queryset.only(*fields)
+    return queryset._cursor
+
+
+def is_unfiltered(queryset):
+    """
+    Returns True if the queryset has no filters besides the ones mongoengine
+    adds for document inheritance.
+    """
+    initial_query = getattr(queryset, '_initial_query', {})
+    return not getattr(queryset, '_where_clause', None) and \
+        queryset._query == initial_query
+
+
+def get_db_field(document, field_name):
+    """returns the name a field of the document is stored under.."""
+    if field_name in ('pk', document._meta['id_field']):
+        return '_id'
+    return document._fields[field_name].db_field
+
+
+def label_from_son(document, son, field_names):
+    """
+    Builds a label from the values of `field_names` in a raw stored
+    document, joined by spaces.
+    """
+    values = [son.get(get_db_field(document, name)) for name in field_names]
+    return u' '.join([smart_unicode(v) for v in values if v is not None])
+
+
+def merge_query(query, extra):
+    """
+    Adds the conditions of `extra` to a raw query, using `$and` when both
+    constrain the same keys.
+    """
+    if not query:
+        return extra
+    if set(query) & set(extra):
+        return {'$and': [query, extra]}
+    merged = dict(query)
+    merged.update(extra)
+    return merged
+
+
+def get_generation(collection_name):
+    """
+    Returns the generation counter of a collection. Cache keys built with
+    `get_queryset_cache_key` include it, so bumping it invalidates every
+    cached value of the collection at once.
+    """
+    key = GENERATION_KEY % collection_name
+    generation = cache.get(key)
+    if generation is None:
+        # start from the clock, so a counter evicted from the cache never
+        # comes back with a value that was already used
+        cache.add(key, int(time.time() * 1000), GENERATION_TIMEOUT)
+        generation = cache.get(key)
+    return generation
+
+
+def bump_generation(collection_name):
+    """invalidates every cached value of a collection.."""
+    key = GENERATION_KEY % collection_name
+    try:
+        return cache.incr(key)
+    except ValueError:
+        return get_generation(collection_name)
+
+
+def invalidate_document_cache(document):
+    """
+    Invalidates every value cached for the collection of a document class,
+    like the choices of reference fields or the counts of list views.
+    """
+    return bump_generation(document.objects._collection.name)
+
+
+def get_queryset_cache_key(prefix, queryset, *extra):
+    """
+    Builds a cache key for a value computed from a queryset. The key
+    depends on the collection generation, the filter, where clause and
+    ordering of the queryset and any `extra` values.
+    """
+    collection_name = queryset._collection.name
+    data = BSON.encode({'q': queryset._query,
+                        'w': unicode(getattr(queryset, '_where_clause',
+                                             None) or u''),
+                        'o': [list(o) for o in queryset._ordering or []],
+                        'e': [unicode(e) for e in extra]})
+
+    return 'mongotools:%s:%s:%s:%s' % (prefix, collection_name,
+                                       get_generation(collection_name),
+                                       hashlib.md5(data).hexdigest())
+
+
+class BSONEncoder(simplejson.JSONEncoder):
+    """
+    Encodes raw stored documents: ObjectIds and references become their id
+    strings, dates ISO 8601 strings and decimals strings, to keep their
+    precision.
+    """
+    def default(self, o):
+        if isinstance(o, ObjectId):
+            return unicode(o)
+        if isinstance(o, DBRef):
+            return unicode(o.id)
+        if isinstance(o, (datetime.datetime, datetime.date, datetime.time)):
+            return o.isoformat()
+        if Decimal128 is not None and isinstance(o, Decimal128):
+            return unicode(o.to_decimal())
+        if isinstance(o, decimal.Decimal):
+            return unicode(o)
+        if isinstance(o, uuid.UUID):
+            return unicode(o)
+        return super(BSONEncoder, self).default(o)
@@ -20,16 +20,88 @@
 # This file is based in Django Class Views
 # adapted for use of mongoengine
 
+import os
+import re
+import csv
+import calendar
+import tempfile
+from cStringIO import StringIO
+
+import gridfs
+from gridfs.errors import NoFile
+from mongoengine.connection import _get_db
+from mongoengine import Document
+from mongoengine.base import ValidationError
+from bson.errors import InvalidId
+
 from django.views.generic.detail import BaseDetailView
 from django.views.generic.edit import FormMixin, ProcessFormView, DeletionMixin
 from django.core.exceptions import ImproperlyConfigured, ObjectDoesNotExist
 from django.views.generic.base import TemplateResponseMixin, View
-from django.http import HttpResponseRedirect, Http404
+from django.http import HttpResponse, HttpResponseRedirect, Http404
+from django.http import HttpResponseNotModified, HttpResponseBadRequest
+from django.core.validators import EMPTY_VALUES
+from django.utils.http import http_date, parse_http_date_safe
 from django.views.generic.list import MultipleObjectMixin
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
+from django.core.paginator import InvalidPage
 from django.shortcuts import render
 from django.contrib import messages
+from django.utils.translation import ugettext as _
+from django.utils import simplejson
+from django.utils.encoding import smart_unicode
+from django.forms.forms import NON_FIELD_ERRORS
+
+from mongotools.views.pagination import (KeysetPage, KeysetPaginator,
+                                         MongoPaginator, has_results)
+from mongotools.forms import StaleDocumentError
+from mongotools.forms.uploadhandler import discard_uploads
+from mongotools.utils import get_db_field, label_from_son, merge_query, raw_cursor
+from mongotools.utils import invalidate_document_cache, BSONEncoder
+from mongotools.views.cache import get_cached_son, cache_son, invalidate_object
+from mongotools.views.cache import has_delete_receivers
+from mongotools.views.cache import (get_page_cache_key, get_cached_page,
+                                    cache_page_on_render)
+from mongotools.views.routing import ReadRoutingMixin
+from mongotools.views.projection import (AUTO, FieldRecorder,
+                                         get_recorded_fields, record_on_render)
+
+def is_not_modified(request, etag, last_modified):
+    """
+    Tells if the conditional headers of the request match the ETag or the
+    Last-Modified timestamp of the current representation.
+    """
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        etags = [e.strip() for e in if_none_match.split(',')]
+        return etag is not None and (etag in etags or '*' in etags)
+
+    if_modified_since = parse_http_date_safe(
+        request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    return if_modified_since is not None and \
+        last_modified is not None and last_modified <= if_modified_since
+
+def object_not_found(document):
+    return Http404(u"No %(verbose_name)s found matching the query" %
+                   {'verbose_name': document.__name__})
+
+def get_raw_object(queryset, fields=None):
+    """
+    Returns the raw stored document of the first match of the queryset,
+    with only `fields` loaded if given, or raises Http404.
+    """
+    for son in raw_cursor(queryset, fields).limit(1):
+        return son
+    raise object_not_found(queryset._document)
+
+def set_validators(response, etag, last_modified):
+    if etag:
+        response['ETag'] = etag
+    if last_modified:
+        response['Last-Modified'] = http_date(last_modified)
+    return response
 
-class MongoSingleObjectMixin(object):
+class MongoSingleObjectMixin(ReadRoutingMixin):
     """
     Provides the ability to retrieve a single object for further manipulation.
     """
@@ -37,6 +109,18 @@ class MongoSingleObjectMixin(object):
     queryset = None
     context_object_name = None
 
+    # fields loaded from the database; 'auto' loads the fields the
+    # template was seen reading
+    only_fields = None
+
+    # keep the raw stored documents in Django's cache
+    cache_objects = False
+    object_cache_timeout = 300
+
+    # a mongotools.audit.AuditWriter writing historic actions in the
+    # background, instead of user.register_historic
+    historic_writer = None
+
     def get_object(self, queryset=None):
         """
         Returns the object the view is displaying.
@@ -56,6 +140,9 @@ class MongoSingleObjectMixin(object):
                                  u" called with object pk."
                                  % self.__class__.__name__)
 
+        if self.use_object_cache(queryset):
+            return self.get_cached_object(queryset, pk)
+
         try:
             obj = queryset.get()
         except queryset._document.DoesNotExist:
@@ -63,28 +150,122 @@ class MongoSingleObjectMixin(object):
                           {'verbose_name': queryset._document.__name__})
         return obj
 
+    def use_object_cache(self, queryset):
+        # writes must start from the stored document, a cached copy saved
+        # back would undo changes made without mongoengine's save or delete
+        request = getattr(self, 'request', None)
+        if request is None or request.method not in ('GET', 'HEAD'):
+            return False
+
+        # filtered or projected querysets would be bypassed by a cache
+        # keyed only by pk
+        return self.cache_objects and not queryset._loaded_fields and \
+            set(queryset._query) - set(['_id']) == \
+            set(getattr(queryset, '_initial_query', {}))
+
+    def get_cached_object(self, queryset, pk):
+        """
+        Returns the object from the raw document cached for its pk, reading
+        and caching it on a miss.
+        """
+        document = queryset._document
+        son = get_cached_son(document, pk)
+
+        if son is None:
+            son = get_raw_object(queryset)
+            cache_son(document, pk, son, self.object_cache_timeout)
+
+        return document._from_son(son)
+
+    def register_historic(self, obj, action):
+        if self.historic_writer is not None:
+            self.historic_writer.register(self.request.user, obj, action)
+        else:
+            self.request.user.register_historic(obj, action)
+
+    def invalidate_object(self):
+        """
+        Drops the cached copy of the object and everything cached for its
+        collection, like list pages and counts.
+        """
+        if self.object is not None and self.object.pk is not None:
+            invalidate_object(self.object.__class__, self.object.pk)
+            invalidate_document_cache(self.object.__class__)
+
     def get_queryset(self):
         """
         Get the queryset to look an object up against. May not be called if
         `get_object` is overridden.
         """
         if self.queryset is None:
-            if self.document:
-                return self.document.objects
-            else:
+            if not self.document:
                 raise ImproperlyConfigured(u"%(cls)s is missing a queryset. Define "
                                            u"%(cls)s.document, %(cls)s.queryset, or override "
                                            u"%(cls)s.get_object()." % {
                                                 'cls': self.__class__.__name__
                                         })
-        return self.queryset.clone()
+            queryset = self.document.objects
+        else:
+            queryset = self.queryset.clone()
+
+        fields = self.get_only_fields()
+        if fields is not None:
+            queryset = queryset.only(*fields)
+        # the fields the object is loaded with, see record_object
+        self._projected_fields = fields
+        return self.route_queryset(queryset)
+
+    def get_only_fields(self):
+        """
+        Get the names of the fields to load, or None to load the whole
+        document.
+        """
+        if self.only_fields == AUTO:
+            return get_recorded_fields(self.__class__)
+        return self.only_fields
+
+    def record_object(self, obj):
+        """
+        Wraps the object to record the fields the template reads, when
+        `only_fields` is 'auto'.
+        """
+        if self.only_fields != AUTO:
+            return obj
+        self._accessed_fields = set()
+        return FieldRecorder(obj, self._accessed_fields,
+                             getattr(self, '_projected_fields', None))
+
+    def record_response(self, response):
+        if getattr(self, '_accessed_fields', None) is None:
+            return response
+        return record_on_render(response, self.__class__,
+                                self._accessed_fields)
 
     def get_context_data(self, **kwargs):
         return kwargs
         
-class MongoMultipleObjectMixin(MultipleObjectMixin):
+class MongoMultipleObjectMixin(MultipleObjectMixin, ReadRoutingMixin):
 
     document = None
+
+    # keyset pagination: pages are fetched with range queries over
+    # `keyset_ordering` (plus the document id) instead of skip/limit
+    keyset_pagination = False
+    keyset_ordering = None
+    page_token_kwarg = 'cursor'
+
+    # how the paginator counts objects, see MongoPaginator
+    paginator_class = MongoPaginator
+    count_strategy = 'exact'
+    count_cap = 10000
+    count_cache_timeout = 60
+
+    # fields loaded for each listed document; 'auto' loads the fields the
+    # template was seen reading
+    list_fields = None
+
+    # pages hold the raw stored documents instead of documents
+    raw_pages = False
     
     def get_queryset(self):
         """
@@ -100,7 +281,113 @@ class MongoMultipleObjectMixin(MultipleObjectMixin):
         else:
             raise ImproperlyConfigured(u"'%s' must define 'queryset' or 'document'"
                                        % self.__class__.__name__)
-        return queryset
+
+        fields = self.get_list_fields()
+        if fields is not None and hasattr(queryset, 'only'):
+            fields = list(fields)
+            # keyset page tokens are built from the sort field
+            ordering = self.keyset_pagination and self.get_keyset_ordering()
+            if ordering:
+                fields.append(ordering.lstrip('-+'))
+            queryset = queryset.only(*fields)
+        # the fields the objects are loaded with, see record_object_list
+        self._projected_fields = fields
+        return self.route_queryset(queryset)
+
+    def get_list_fields(self):
+        """
+        Get the names of the fields to load for each document, or None to
+        load whole documents.
+        """
+        if self.list_fields == AUTO:
+            return get_recorded_fields(self.__class__)
+        return self.list_fields
+
+    def record_object_list(self, context):
+        """
+        Wraps the listed objects of the context to record the fields the
+        template reads, when `list_fields` is 'auto'.
+        """
+        if self.list_fields != AUTO:
+            return context
+
+        self._accessed_fields = set()
+        object_list = context['object_list']
+        loaded = getattr(self, '_projected_fields', None)
+        recorded = [FieldRecorder(obj, self._accessed_fields, loaded)
+                    for obj in object_list]
+
+        for key, value in context.items():
+            if value is object_list:
+                context[key] = recorded
+
+        if context.get('page_obj') is not None:
+            context['page_obj'].object_list = recorded
+        return context
+
+    def record_response(self, response):
+        if getattr(self, '_accessed_fields', None) is None:
+            return response
+        return record_on_render(response, self.__class__,
+                                self._accessed_fields)
+
+    def get_keyset_ordering(self):
+        """
+        Get the field used to sort and slice keyset pages. Defaults to the
+        first ordering of the document meta, or the document id.
+        """
+        if self.keyset_ordering:
+            return self.keyset_ordering
+
+        document = self.document
+        if document is None and self.queryset is not None:
+            document = self.queryset._document
+
+        ordering = document._meta.get('ordering') or []
+        return ordering and ordering[0] or None
+
+    def get_paginator(self, queryset, per_page, orphans=0, allow_empty_first_page=True):
+        """
+        Return an instance of the paginator for this view.
+        """
+        kwargs = {}
+        if self.raw_pages:
+            kwargs = {'raw': True, 'fields': self.get_list_fields()}
+
+        if self.keyset_pagination:
+            return KeysetPaginator(queryset, per_page,
+                                   ordering=self.get_keyset_ordering(),
+                                   allow_empty_first_page=allow_empty_first_page,
+                                   **kwargs)
+
+        return self.paginator_class(queryset, per_page, orphans=orphans,
+                                    allow_empty_first_page=allow_empty_first_page,
+                                    count_strategy=self.count_strategy,
+                                    count_cap=self.count_cap,
+                                    count_cache_timeout=self.count_cache_timeout,
+                                    **kwargs)
+
+    def paginate_queryset(self, queryset, page_size):
+        """
+        Paginate the queryset, if needed.
+        """
+        if not self.keyset_pagination:
+            return super(MongoMultipleObjectMixin, self).paginate_queryset(
+                queryset, page_size)
+
+        paginator = self.get_paginator(
+            queryset, page_size, allow_empty_first_page=self.get_allow_empty())
+        token = self.kwargs.get(self.page_token_kwarg) or \
+            self.request.GET.get(self.page_token_kwarg)
+
+        try:
+            page = paginator.page(token)
+        except InvalidPage:
+            raise Http404(_(u'Invalid page (%(page_token)s)') % {
+                'page_token': token
+            })
+
+        return (paginator, page, page.object_list, page.has_other_pages())
 
 class MongoSingleObjectTemplateResponseMixin(TemplateResponseMixin):
     template_name_field = None
@@ -149,6 +436,51 @@ class MongoFormMixin(FormMixin, MongoSingleObjectMixin):
     historic_action = None
     save_permission = None
 
+    # an upload handler, like GridFSUploadHandler, installed before the
+    # request body is read; as the csrf middleware would read the body
+    # first, such views are csrf_exempt and run the csrf check themselves
+    upload_handler_class = None
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        view = super(MongoFormMixin, cls).as_view(**initkwargs)
+        if initkwargs.get('upload_handler_class',
+                          cls.upload_handler_class) is not None:
+            view = csrf_exempt(view)
+        return view
+
+    def dispatch(self, request, *args, **kwargs):
+        if self.upload_handler_class is None:
+            return super(MongoFormMixin, self).dispatch(
+                request, *args, **kwargs)
+
+        if request.method in ('POST', 'PUT'):
+            request.upload_handlers.insert(
+                0, self.upload_handler_class(request))
+
+        # the files are streamed into GridFS when the csrf check reads the
+        # body; unless a saved document references them, whatever answers
+        # the request (a csrf failure, a 404, an error) drops them
+        self.request = request
+        self.uploads_saved = False
+        try:
+            return csrf_protect(super(MongoFormMixin, self).dispatch)(
+                request, *args, **kwargs)
+        finally:
+            if not self.uploads_saved:
+                self.discard_uploads()
+
+    def discard_uploads(self):
+        # files streamed into GridFS by the upload handler, a body never
+        # parsed has none
+        if self.upload_handler_class is not None and \
+           hasattr(self.request, '_files'):
+            discard_uploads(self.request.FILES)
+
+    def get_only_fields(self):
+        # the form saves the whole document back, so it must be loaded
+        return None
+
     def get_form_class(self):
         """
         Returns the form class to use in this view
@@ -185,15 +517,23 @@ class MongoFormMixin(FormMixin, MongoSingleObjectMixin):
 
     def write_historic(self):
         if self.historic_action:
-            self.request.user.register_historic(self.object,
-                                                self.historic_action)
+            self.register_historic(self.object, self.historic_action)
 
     def form_valid(self, form):
         if self.save_permission:
             if not self.request.user.has_perm(self.save_permission):
                 return render(self.request, 'access_denied.html', locals())
-        self.object = form.save()
+        try:
+            self.object = form.save()
+            self.uploads_saved = True
+        except StaleDocumentError:
+            form._errors[NON_FIELD_ERRORS] = form.error_class([
+                _(u"This %s was changed by someone else, please review the"
+                  u" changes and try again.") % self.object.__class__.__name__])
+            return self.form_invalid(form)
 
+        self.invalidate_object()
+        self.record_write()
         self.write_historic()
         self.send_messages()
 
@@ -207,16 +547,76 @@ class MongoFormMixin(FormMixin, MongoSingleObjectMixin):
         
 class BaseDetailView(MongoSingleObjectMixin, View):
     historic_view_action = None
+
+    # conditional GET: a version counter and/or a modification datetime
+    # of the document, checked with a query loading only those fields
+    etag_field = None
+    last_modified_field = None
+
+    def get_validator_fields(self):
+        return [f for f in (self.etag_field, self.last_modified_field) if f]
+
+    def get_only_fields(self):
+        fields = super(BaseDetailView, self).get_only_fields()
+        if fields is not None:
+            # the validators of 200 responses are read from the object
+            fields = list(fields) + self.get_validator_fields()
+        return fields
+
+    def make_validators(self, pk, version, modified):
+        etag = last_modified = None
+        if self.etag_field:
+            etag = '"%s:%s"' % (pk, version)
+        if self.last_modified_field and modified is not None:
+            last_modified = calendar.timegm(modified.utctimetuple())
+        return etag, last_modified
+
+    def get_validators(self):
+        """
+        Returns the ETag and the Last-Modified timestamp of the object,
+        loading only the fields they are built from.
+        """
+        queryset = self.get_queryset().filter(pk=self.kwargs.get('pk'))
+        document = queryset._document
+        son = get_raw_object(queryset, self.get_validator_fields())
+
+        return self.make_validators(
+            son['_id'],
+            self.etag_field and
+            son.get(get_db_field(document, self.etag_field)),
+            self.last_modified_field and
+            son.get(get_db_field(document, self.last_modified_field)))
+
+    def get_object_validators(self, obj):
+        """returns the validators of an object already loaded.."""
+        return self.make_validators(
+            obj.pk,
+            self.etag_field and getattr(obj, self.etag_field),
+            self.last_modified_field and
+            getattr(obj, self.last_modified_field))
+
     def get(self, request, **kwargs):
+        use_validators = self.etag_field or self.last_modified_field
+        etag = last_modified = None
+
+        # only conditional requests pay for the query of the validators
+        if use_validators and ('HTTP_IF_NONE_MATCH' in request.META or
+                               'HTTP_IF_MODIFIED_SINCE' in request.META):
+            etag, last_modified = self.get_validators()
+            if is_not_modified(request, etag, last_modified):
+                return set_validators(HttpResponseNotModified(), etag,
+                                      last_modified)
+
         self.object = self.get_object()
-        context = self.get_context_data(object=self.object)
+        if use_validators:
+            etag, last_modified = self.get_object_validators(self.object)
+        context = self.get_context_data(object=self.record_object(self.object))
 
         if self.historic_view_action:
-            self.request.user.register_historic(
-                self.object,
-                self.historic_view_action)
+            self.register_historic(self.object, self.historic_view_action)
 
-        return self.render_to_response(context)
+        response = self.record_response(self.render_to_response(context))
+        return set_validators(response, etag, last_modified)
 
 class BaseCreateView(MongoFormMixin, ProcessFormView):
     """
@@ -271,18 +671,56 @@ class DeletionMixin(object):
     success_message = None
     historic_action = None
 
+    # delete with a single find_and_modify, loading only `delete_fields`
+    # for the message and the historic instead of the whole document
+    fast_delete = False
+    delete_fields = ()
+
+    def use_fast_delete(self):
+        # delete rules, overridden delete methods and the receivers of the
+        # delete signals need the document
+        document = self.get_queryset()._document
+        return self.fast_delete and \
+            not document._meta.get('delete_rules') and \
+            document.delete.im_func is Document.delete.im_func and \
+            not has_delete_receivers(document)
+
+    def delete_object(self):
+        """
+        Removes the object and returns it, with only its id and
+        `delete_fields` loaded.
+        """
+        queryset = self.get_queryset().filter(pk=self.kwargs.get('pk'))
+        document = queryset._document
+
+        fields = {'_id': True, '_cls': True}
+        for name in self.delete_fields:
+            fields[get_db_field(document, name)] = True
+
+        son = queryset._collection.find_and_modify(
+            queryset._query, remove=True, fields=fields)
+        if son is None:
+            raise object_not_found(document)
+        return document._from_son(son)
+
     def delete(self, request, *args, **kwargs):
-        self.object = self.get_object()
+        fast_delete = self.use_fast_delete()
+        if fast_delete:
+            self.object = self.delete_object()
+        else:
+            self.object = self.get_object()
         msg = None
 
         if self.success_message:
             msg = self.success_message % self.object
 
         if self.historic_action:
-            self.request.user.register_historic(self.object,
-                                                self.historic_action)
+            self.register_historic(self.object, self.historic_action)
 
-        self.object.delete()
+        if not fast_delete:
+            self.object.delete()
+        self.invalidate_object()
+        self.record_write()
         return HttpResponseRedirect(self.get_success_url())
 
     # Add support for browsers which only accept GET and POST for now.
@@ -314,15 +752,46 @@ class BaseListView(MongoMultipleObjectMixin, View):
     def get(self, request, *args, **kwargs):
         self.object_list = self.get_queryset()
         allow_empty = self.get_allow_empty()
-        if not allow_empty and len(self.object_list) == 0:
+        if not allow_empty and not has_results(self.object_list):
             raise Http404(_(u"Empty list and '%(class_name)s.allow_empty' is False.")
                           % {'class_name': self.__class__.__name__})
         context = self.get_context_data(object_list=self.object_list)
-        return self.render_to_response(context)
+        context = self.record_object_list(context)
+        return self.record_response(self.render_to_response(context))
 
 class MongoMultipleObjectTemplateResponseMixin(TemplateResponseMixin):
     template_name_suffix = 'list'
 
+    # cache the rendered pages until the collection changes, see
+    # mongotools.views.cache.get_page_cache_key
+    cache_pages = False
+    page_cache_timeout = 60
+
+    def get_page_cache_key(self):
+        """
+        Returns the cache key of the requested page. Pages reading the
+        session or setting cookies are not cached, other per-user content
+        must add the user to the key.
+        """
+        collection_name = self.get_queryset()._collection.name
+        return get_page_cache_key(self, collection_name,
+                                  self.request.get_full_path())
+
+    def get(self, request, *args, **kwargs):
+        if not self.cache_pages:
+            return super(MongoMultipleObjectTemplateResponseMixin,
+                         self).get(request, *args, **kwargs)
+
+        key = self.get_page_cache_key()
+        response = get_cached_page(key)
+        if response is not None:
+            return response
+
+        response = super(MongoMultipleObjectTemplateResponseMixin,
+                         self).get(request, *args, **kwargs)
+        return cache_page_on_render(request, response, key,
+                                    self.page_cache_timeout)
+
     def get_template_names(self):
         """
         Return a list of template names to be used for the request. Must return
@@ -349,3 +818,605 @@ class ListView(MongoMultipleObjectTemplateResponseMixin, BaseListView):
     Render some list of objects, set by `self.model` or `self.queryset`.
     `self.queryset` can actually be any iterable of items, not just a queryset.
     """
+
+
+class JSONResponseMixin(object):
+    """
+    Renders raw stored documents as JSON, with `json_encoder_class`.
+    Stored field names are mapped back to the document field names and the
+    id is rendered as `id`.
+    """
+    json_encoder_class = BSONEncoder
+
+    def get_field_names(self, document):
+        names = dict([(field.db_field, name) for name, field in
+                      document._fields.items()])
+        names['_id'] = 'id'
+        return names
+
+    def serialize(self, son, names):
+        return dict([(names.get(key, key), value)
+                     for key, value in son.iteritems()
+                     if key not in ('_cls', '_types')])
+
+    def render_to_json_response(self, data, **kwargs):
+        return HttpResponse(simplejson.dumps(data, cls=self.json_encoder_class),
+                            content_type='application/json', **kwargs)
+
+
+class JSONDetailView(JSONResponseMixin, MongoSingleObjectMixin, View):
+    """
+    Renders the object as JSON straight from the raw stored document, with
+    only `only_fields` loaded, without instantiating a document.
+    """
+    def get(self, request, *args, **kwargs):
+        queryset = self.get_queryset().filter(pk=self.kwargs.get('pk'))
+        document = queryset._document
+        son = get_raw_object(queryset)
+
+        return self.render_to_json_response(
+            self.serialize(son, self.get_field_names(document)))
+
+
+class JSONListView(JSONResponseMixin, MongoMultipleObjectMixin, View):
+    """
+    Renders the documents as JSON, `{"results": [...]}`, straight from the
+    raw cursor with only `list_fields` loaded. With `paginate_by`, the
+    page is paginated as in ListView and described under `pagination`.
+    """
+    raw_pages = True
+
+    def get_pagination_data(self, paginator, page):
+        if isinstance(page, KeysetPage):
+            return {'next': page.next_page_token(),
+                    'previous': page.previous_page_token()}
+
+        return {'page': page.number,
+                'has_next': page.has_next(),
+                'has_previous': page.has_previous(),
+                'count': paginator.count,
+                'count_is_exact': getattr(paginator, 'count_is_exact', True)}
+
+    def get(self, request, *args, **kwargs):
+        queryset = self.get_queryset()
+        names = self.get_field_names(queryset._document)
+        page_size = self.get_paginate_by(queryset)
+        data = {}
+
+        if page_size:
+            paginator, page, object_list, is_paginated = \
+                self.paginate_queryset(queryset, page_size)
+            data['pagination'] = self.get_pagination_data(paginator, page)
+        else:
+            object_list = raw_cursor(queryset)
+
+        data['results'] = [self.serialize(son, names) for son in object_list]
+        return self.render_to_json_response(data)
+
+
+class ExportView(MongoMultipleObjectMixin, View):
+    """
+    Streams `export_fields` of every document of the queryset as CSV or as
+    JSON lines (`export_format` 'csv' or 'ndjson', or the `format_kwarg`
+    query parameter).
+
+    Rows are read from the raw cursor in batches of `batch_size` and encoded
+    as the response is sent, so no document is instantiated nor kept. Any
+    middleware reading the whole content, like GZipMiddleware or the ETags
+    of CommonMiddleware, defeats the streaming.
+    """
+    export_fields = ()
+    export_format = 'csv'
+    export_formats = ('csv', 'ndjson')
+    format_kwarg = 'format'
+    batch_size = 1000
+    # rows encoded per chunk sent to the client
+    rows_per_chunk = 100
+    filename = None
+
+    def get_export_fields(self):
+        if not self.export_fields:
+            raise ImproperlyConfigured(u"'%s' must define 'export_fields'"
+                                       % self.__class__.__name__)
+        return self.export_fields
+
+    def get_export_format(self):
+        export_format = self.request.GET.get(self.format_kwarg,
+                                             self.export_format)
+        if export_format not in self.export_formats:
+            raise Http404(u"Unknown export format %s" % export_format)
+        return export_format
+
+    def get_filename(self, export_format):
+        name = self.filename or \
+            self.get_queryset()._document.__name__.lower()
+        return '%s.%s' % (name, export_format)
+
+    def iter_rows(self, fields):
+        """yields the exported values of each document, as a list.."""
+        queryset = self.get_queryset()
+        document = queryset._document
+        db_fields = [get_db_field(document, name) for name in fields]
+
+        # the id is always loaded
+        only = [name for name, db_field in zip(fields, db_fields)
+                if db_field != '_id'] or [document._meta['id_field']]
+        cursor = raw_cursor(queryset, only).batch_size(self.batch_size)
+        for son in cursor:
+            yield [son.get(db_field) for db_field in db_fields]
+
+    def iter_chunks(self, lines):
+        buffer = []
+        for line in lines:
+            buffer.append(line)
+            if len(buffer) >= self.rows_per_chunk:
+                yield ''.join(buffer)
+                buffer = []
+        if buffer:
+            yield ''.join(buffer)
+
+    def iter_csv(self, fields):
+        output = StringIO()
+        writer = csv.writer(output)
+
+        def encode(row):
+            writer.writerow([u'' if value is None else
+                             smart_unicode(value).encode('utf-8')
+                             for value in row])
+            line = output.getvalue()
+            output.seek(0)
+            output.truncate()
+            return line
+
+        yield encode(fields)
+        for row in self.iter_rows(fields):
+            yield encode(row)
+
+    def iter_ndjson(self, fields):
+        encoder = BSONEncoder(ensure_ascii=False)
+        for row in self.iter_rows(fields):
+            yield encoder.encode(dict(zip(fields, row))).encode('utf-8') + '\n'
+
+    def get(self, request, *args, **kwargs):
+        fields = list(self.get_export_fields())
+        export_format = self.get_export_format()
+
+        if export_format == 'csv':
+            lines = self.iter_csv(fields)
+            content_type = 'text/csv; charset=utf-8'
+        else:
+            lines = self.iter_ndjson(fields)
+            content_type = 'application/x-ndjson; charset=utf-8'
+
+        response = HttpResponse(self.iter_chunks(lines),
+                                content_type=content_type)
+        response['Content-Disposition'] = 'attachment; filename="%s"' % \
+            self.get_filename(export_format).replace('"', '')
+        return response
+
+
+class ReferenceSearchView(MongoMultipleObjectMixin, View):
+    """
+    Searches the documents of `self.document` or `self.queryset` and
+    returns at most `search_limit` matches as JSON, in the form
+    `{"results": [{"id": ..., "text": ...}]}`. It is the server side of
+    `mongotools.forms.widgets.AutocompleteSelect`.
+
+    By default matches are documents where one of `search_fields` starts
+    with the search term, which can use an index on those fields. With
+    `text_search` a `$text` query is run instead, ordered by relevance.
+    """
+    search_fields = ()
+    label_fields = None
+    text_search = False
+    search_limit = 20
+    min_length = 1
+    search_kwarg = 'q'
+
+    def get_search_fields(self):
+        if not self.search_fields:
+            raise ImproperlyConfigured(u"'%s' must define 'search_fields'"
+                                       % self.__class__.__name__)
+        return self.search_fields
+
+    def get_label_fields(self):
+        return self.label_fields or self.search_fields
+
+    def get_search_query(self, term):
+        """
+        Get the raw query matching the search term.
+        """
+        if self.text_search:
+            return {'$text': {'$search': term}}
+
+        document = self.object_list._document
+        regex = re.compile(u'^%s' % re.escape(term), re.UNICODE)
+        conditions = [{get_db_field(document, name): regex}
+                      for name in self.get_search_fields()]
+
+        if len(conditions) == 1:
+            return conditions[0]
+        return {'$or': conditions}
+
+    def get_search_cursor(self, term):
+        queryset = self.object_list
+        document = queryset._document
+
+        fields = dict([(get_db_field(document, name), 1)
+                       for name in self.get_label_fields()])
+        query = merge_query(queryset._query, self.get_search_query(term))
+
+        if self.text_search:
+            fields['score'] = {'$meta': 'textScore'}
+            cursor = queryset._collection.find(query, fields=fields)
+            cursor = cursor.sort([('score', {'$meta': 'textScore'})])
+        else:
+            cursor = queryset._collection.find(query, fields=fields)
+            cursor = cursor.sort(get_db_field(document,
+                                              self.get_search_fields()[0]))
+
+        return cursor.limit(self.search_limit)
+
+    def label_from_son(self, son):
+        return label_from_son(self.object_list._document, son,
+                              self.get_label_fields())
+
+    def get(self, request, *args, **kwargs):
+        self.object_list = self.get_queryset()
+        term = request.GET.get(self.search_kwarg, u'').strip()
+        results = []
+
+        if len(term) >= self.min_length:
+            results = [{'id': unicode(son['_id']),
+                        'text': self.label_from_son(son)}
+                       for son in self.get_search_cursor(term)]
+
+        return HttpResponse(simplejson.dumps({'results': results}),
+                            content_type='application/json')
+
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+class GridFSFileView(MongoSingleObjectMixin, View):
+    """
+    Serves the content of the FileField `file_field` of the document
+    looked up by `get_object`.
+
+    Files are streamed chunk by chunk, single byte ranges are honored with
+    206 responses, and the ETag (from the stored md5) and Last-Modified
+    (from uploadDate) headers answer conditional requests with a 304.
+
+    With `offload` set to 'x-accel-redirect' or 'x-sendfile' the file is
+    copied once to `offload_cache_dir` and the web server is told to send
+    it from there; `offload_url_prefix` is the internal nginx location of
+    that directory.
+    """
+    file_field = None
+    as_attachment = False
+    stream_chunk_size = 256 * 1024
+
+    offload = None
+    offload_cache_dir = None
+    offload_url_prefix = None
+
+    def get_only_fields(self):
+        return [self.file_field]
+
+    def get_file(self):
+        """
+        Returns the GridOut of the served file, or raises Http404.
+        """
+        if not self.file_field:
+            raise ImproperlyConfigured(u"%s is missing a file_field." %
+                                       self.__class__.__name__)
+
+        self.object = self.get_object()
+        proxy = getattr(self.object, self.file_field)
+        grid_id = getattr(proxy, 'grid_id', None)
+
+        try:
+            if grid_id is None:
+                raise NoFile()
+            return gridfs.GridFS(_get_db()).get(grid_id)
+        except NoFile:
+            raise Http404(u"%s has no file" % self.object.__class__.__name__)
+
+    def get_etag(self, grid_out):
+        if grid_out.md5:
+            return '"%s"' % grid_out.md5
+        return None
+
+    def get_last_modified(self, grid_out):
+        if grid_out.upload_date:
+            return calendar.timegm(grid_out.upload_date.utctimetuple())
+        return None
+
+    def get_range(self, length, etag, last_modified):
+        """
+        Returns the `(start, end)` byte range requested, both inclusive,
+        None to send the whole file, or False for an unsatisfiable range.
+        """
+        header = self.request.META.get('HTTP_RANGE')
+        if not header:
+            return None
+
+        # a stale If-Range asks for the whole (new) file
+        if_range = self.request.META.get('HTTP_IF_RANGE')
+        if if_range and if_range != etag and \
+           parse_http_date_safe(if_range) != last_modified:
+            return None
+
+        # only single ranges are supported, others get the whole file
+        match = RANGE_RE.match(header.strip())
+        if not match or not any(match.groups()):
+            return None
+
+        start, end = match.groups()
+        if not start:
+            # suffix range, the last `end` bytes
+            start, end = max(length - int(end), 0), length - 1
+        else:
+            start = int(start)
+            if end:
+                end = min(int(end), length - 1)
+            else:
+                end = length - 1
+
+        if start > end or start >= length:
+            return False
+        return start, end
+
+    def stream(self, grid_out, start, end):
+        grid_out.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            data = grid_out.read(min(self.stream_chunk_size, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+
+    def get_cached_path(self, grid_out):
+        """
+        Returns the path of the local copy of the file, writing it first if
+        it is not cached yet.
+        """
+        path = os.path.join(self.offload_cache_dir, str(grid_out._id))
+        if not os.path.exists(path):
+            fd, tmp_path = tempfile.mkstemp(dir=self.offload_cache_dir)
+            with os.fdopen(fd, 'wb') as tmp:
+                for data in self.stream(grid_out, 0, grid_out.length - 1):
+                    tmp.write(data)
+            # rename is atomic, concurrent requests never see partial files
+            os.rename(tmp_path, path)
+        return path
+
+    def get(self, request, *args, **kwargs):
+        grid_out = self.get_file()
+        etag = self.get_etag(grid_out)
+        last_modified = self.get_last_modified(grid_out)
+
+        if is_not_modified(request, etag, last_modified):
+            response = HttpResponseNotModified()
+        elif self.offload:
+            response = self.offload_response(grid_out)
+        else:
+            response = self.stream_response(grid_out, etag, last_modified)
+
+        return set_validators(response, etag, last_modified)
+
+    def offload_response(self, grid_out):
+        if not self.offload_cache_dir:
+            raise ImproperlyConfigured(u"%s sets offload without an"
+                                       u" offload_cache_dir." %
+                                       self.__class__.__name__)
+        if self.offload == 'x-accel-redirect' and not self.offload_url_prefix:
+            raise ImproperlyConfigured(u"%s sets offload to x-accel-redirect"
+                                       u" without an offload_url_prefix." %
+                                       self.__class__.__name__)
+
+        path = self.get_cached_path(grid_out)
+        response = HttpResponse(content_type=grid_out.content_type or
+                                'application/octet-stream')
+        if self.offload == 'x-accel-redirect':
+            response['X-Accel-Redirect'] = '%s/%s' % (
+                self.offload_url_prefix.rstrip('/'), os.path.basename(path))
+        else:
+            response['X-Sendfile'] = path
+        self.set_disposition(response, grid_out)
+        return response
+
+    def stream_response(self, grid_out, etag, last_modified):
+        length = grid_out.length
+        content_type = grid_out.content_type or 'application/octet-stream'
+        byte_range = self.get_range(length, etag, last_modified)
+
+        if byte_range is False:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */%s' % length
+            return response
+
+        if byte_range is None:
+            start, end = 0, length - 1
+            response = HttpResponse(self.stream(grid_out, start, end),
+                                    content_type=content_type)
+        else:
+            start, end = byte_range
+            response = HttpResponse(self.stream(grid_out, start, end),
+                                    content_type=content_type, status=206)
+            response['Content-Range'] = 'bytes %s-%s/%s' % (start, end, length)
+
+        response['Content-Length'] = str(end - start + 1)
+        response['Accept-Ranges'] = 'bytes'
+        self.set_disposition(response, grid_out)
+        return response
+
+    def set_disposition(self, response, grid_out):
+        if self.as_attachment and grid_out.filename:
+            response['Content-Disposition'] = 'attachment; filename="%s"' % \
+                grid_out.filename.replace('"', '')
+
+
+class BaseBulkView(MongoMultipleObjectMixin, View):
+    """
+    Applies one server side operation to many documents of `self.document`
+    or `self.queryset`, picked by the pks posted as `pk_kwarg` or by the
+    filters of `filter_form_class` (see `get_filter_kwargs`).
+
+    Nothing is loaded into the application: the view redirects to
+    `success_url` with the counts in `success_message`, or answers ajax
+    requests with the counts as JSON.
+    """
+    pk_kwarg = 'pk'
+    filter_form_class = None
+    # a filter form left empty picks every document of the queryset
+    apply_to_all = False
+    success_url = None
+    success_message = None
+
+    def get_pks(self):
+        return [pk for pk in self.request.POST.getlist(self.pk_kwarg) if pk]
+
+    def validate_pks(self, pks):
+        """
+        Returns the pks converted by the id field, raises ValidationError
+        or InvalidId when one is malformed.
+        """
+        document = self.get_queryset()._document
+        id_field = document._fields[document._meta['id_field']]
+        return [id_field.to_mongo(pk) for pk in pks]
+
+    def get_filter_kwargs(self, form):
+        """
+        Returns the queryset filters of a valid filter form, by default its
+        non empty values by field name.
+        """
+        return dict([(str(name), value) for name, value in
+                     form.cleaned_data.items() if value not in EMPTY_VALUES])
+
+    def get_bulk_queryset(self):
+        """
+        Returns the queryset of the documents to change, or None if the
+        posted filters are not valid. Without pks nor a filter form nothing
+        is changed, and an empty filter form is rejected unless
+        `apply_to_all` is set: a bulk view never applies to a whole
+        collection by accident.
+        """
+        queryset = self.get_queryset()
+        pks = self.get_pks()
+
+        if pks or self.filter_form_class is None:
+            return queryset.filter(pk__in=self.validate_pks(pks))
+
+        form = self.filter_form_class(self.request.POST)
+        if not form.is_valid():
+            return None
+
+        filters = self.get_filter_kwargs(form)
+        if not filters and not self.apply_to_all:
+            return None
+        return queryset.filter(**filters)
+
+    def get_success_url(self):
+        if self.success_url:
+            return self.success_url
+        raise ImproperlyConfigured(
+            "No URL to redirect to. Provide a success_url.")
+
+    def bulk_response(self, result):
+        invalidate_document_cache(self.get_queryset()._document)
+        self.record_write()
+
+        if self.request.is_ajax():
+            return HttpResponse(simplejson.dumps(result),
+                                content_type='application/json')
+
+        if self.success_message:
+            messages.success(self.request, self.success_message % result)
+        return HttpResponseRedirect(self.get_success_url())
+
+    def post(self, request, *args, **kwargs):
+        try:
+            queryset = self.get_bulk_queryset()
+        except (ValidationError, InvalidId):
+            queryset = None
+        if queryset is None:
+            return HttpResponseBadRequest()
+        return self.bulk_response(self.apply(queryset))
+
+
+class BulkDeleteView(BaseBulkView):
+    """
+    Deletes the picked documents with a single `remove`. Documents
+    declaring delete rules go through mongoengine's queryset delete, which
+    applies them. `success_message` is formatted with `deleted`.
+    """
+    def apply(self, queryset):
+        document = queryset._document
+        if document._meta.get('delete_rules'):
+            deleted = queryset.count()
+            queryset.delete()
+        else:
+            result = queryset._collection.remove(queryset._query, safe=True)
+            deleted = result and result.get('n') or 0
+        return {'deleted': deleted}
+
+
+class BulkUpdateView(BaseBulkView):
+    """
+    Updates the picked documents with a single multi `update`, built from
+    `update`, mongoengine update keywords like `{'set__flagged': True}`.
+
+    Views changing each document differently return `(pk, update)` pairs
+    from `get_item_updates` instead; they are sent as one bulk operation,
+    `ordered` or not.
+
+    `success_message` is formatted with `matched` and `modified`.
+    """
+    update = None
+    ordered = False
+
+    def get_update(self):
+        return self.update
+
+    def get_item_updates(self):
+        return None
+
+    def transform_update(self, queryset, update):
+        return queryset._transform_update(queryset._document, **update)
+
+    def apply(self, queryset):
+        items = self.get_item_updates()
+        if items is not None:
+            return self.apply_items(queryset, items)
+
+        update = self.get_update()
+        if not update:
+            raise ImproperlyConfigured(u"'%s' must define 'update'"
+                                       % self.__class__.__name__)
+
+        result = queryset._collection.update(
+            queryset._query, self.transform_update(queryset, update),
+            multi=True, safe=True) or {}
+        matched = result.get('n', 0)
+        # servers older than 2.6 do not tell how many documents changed
+        return {'matched': matched,
+                'modified': result.get('nModified', matched)}
+
+    def apply_items(self, queryset, items):
+        collection = queryset._collection
+        if self.ordered:
+            bulk = collection.initialize_ordered_bulk_op()
+        else:
+            bulk = collection.initialize_unordered_bulk_op()
+
+        document = queryset._document
+        id_field = document._fields[document._meta['id_field']]
+        for pk, update in items:
+            # the filters of the queryset still apply to each item
+            query = merge_query(queryset._query, {'_id': id_field.to_mongo(pk)})
+            bulk.find(query).update_one(self.transform_update(queryset, update))
+
+        result = bulk.execute()
+        return {'matched': result['nMatched'],
+                'modified': result.get('nModified', result['nMatched'])}
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Copyright (C) 2011 Wilson Pinto Júnior <wilsonpjunior@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils import translation
+
+from mongotools.utils import get_generation, invalidate_document_cache
+
+try:
+    from mongoengine import signals
+except ImportError:
+    # mongoengine without signals, documents saved outside of mongotools
+    # views must be invalidated by hand
+    signals = None
+
+OBJECT_KEY = 'mongotools:object:%s:%s:%s'
+PAGE_KEY = 'mongotools:page:%s:%s:%s:%s'
+
+
+def get_object_cache_key(document, pk):
+    # writes changing many documents at once, like the bulk views, only
+    # bump the generation of the collection
+    collection_name = document._meta.get('collection') or \
+        document.__name__.lower()
+    # the pk of the url and the pk of a saved document share the entry
+    pk = document._fields[document._meta['id_field']].to_python(pk)
+    return OBJECT_KEY % (collection_name, get_generation(collection_name), pk)
+
+
+def get_cached_son(document, pk):
+    """
+    Returns the raw stored document cached for `pk`, or None.
+    """
+    return cache.get(get_object_cache_key(document, pk))
+
+
+def cache_son(document, pk, son, timeout):
+    cache.set(get_object_cache_key(document, pk), son, timeout)
+
+
+def invalidate_object(document, pk):
+    """
+    Drops the cached copy of a document, to be called by code changing
+    documents without mongoengine's save or delete.
+    """
+    cache.delete(get_object_cache_key(document, pk))
+
+
+def get_page_cache_key(view, collection_name, path):
+    """
+    Builds the cache key of a rendered page from the view class, the full
+    path of the request (query parameters and page included) and the
+    generation of the collection, so bumping the generation invalidates
+    every page listing the collection at once. Pages are rendered in the
+    active language, which is part of the key too.
+    """
+    if settings.USE_I18N:
+        path = '%s:%s' % (translation.get_language(), path)
+    view_cls = view.__class__
+    return PAGE_KEY % ('%s.%s' % (view_cls.__module__, view_cls.__name__),
+                       collection_name, get_generation(collection_name),
+                       hashlib.md5(path).hexdigest())
+
+
+def get_cached_page(key):
+    page = cache.get(key)
+    if page is None:
+        return None
+
+    content_type, content = page
+    return HttpResponse(content, content_type=content_type)
+
+
+def is_shared_page(request, response):
+    """
+    Tells if a rendered page is the same for every user: a plain 200 that
+    sets no cookie and does not vary on them. Pages that read the session
+    (`request.user` does) or use a csrf token get `Vary: Cookie` from the
+    middleware, after they are rendered.
+    """
+    if response.status_code != 200 or response.cookies:
+        return False
+
+    vary = [header.strip().lower() for header in
+            response.get('Vary', '').split(',')]
+    if 'cookie' in vary:
+        return False
+
+    session = getattr(request, 'session', None)
+    if session is not None and getattr(session, 'accessed', False):
+        return False
+    return not request.META.get('CSRF_COOKIE_USED')
+
+
+def cache_page_on_render(request, response, key, timeout):
+    """
+    Stores the response content once rendered, if it is the same for every
+    user, see is_shared_page.
+    """
+    def callback(response):
+        if is_shared_page(request, response):
+            cache.set(key, (response['Content-Type'], response.content),
+                      timeout)
+
+    if hasattr(response, 'add_post_render_callback'):
+        response.add_post_render_callback(callback)
+    else:
+        callback(response)
+    return response
+
+
+def _invalidate_on_signal(sender, document, **kwargs):
+    if document.pk is not None:
+        invalidate_object(document.__class__, document.pk)
+    invalidate_document_cache(document.__class__)
+
+
+def has_delete_receivers(document):
+    """
+    Tells if something besides the cache listens to the delete signals of
+    the document, so deletes must go through mongoengine.
+    """
+    if signals is None or not getattr(signals, 'signals_available', True):
+        return False
+
+    for signal in (signals.pre_delete, signals.post_delete):
+        for receiver in signal.receivers_for(document):
+            if receiver is not _invalidate_on_signal:
+                return True
+    return False
+
+
+if signals is not None and getattr(signals, 'signals_available', True):
+    signals.post_save.connect(_invalidate_on_signal)
+    signals.post_delete.connect(_invalidate_on_signal)
@@ -0,0 +1,390 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Copyright (C) 2011 Wilson Pinto Júnior <wilsonpjunior@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import base64
+
+from bson import BSON
+from bson.errors import BSONError
+from django.core.cache import cache
+from django.core.paginator import Paginator, Page, InvalidPage, EmptyPage
+from mongoengine import Q
+
+from mongotools.utils import get_queryset_cache_key, is_unfiltered
+from mongotools.utils import get_db_field, raw_cursor
+
+NEXT = 'n'
+PREVIOUS = 'p'
+
+# count strategies understood by MongoPaginator
+COUNT_EXACT = 'exact'
+COUNT_EXISTS = 'exists'
+COUNT_ESTIMATED = 'estimated'
+COUNT_CAPPED = 'capped'
+COUNT_CACHED = 'cached'
+
+COUNT_STRATEGIES = (COUNT_EXACT, COUNT_EXISTS, COUNT_ESTIMATED,
+                    COUNT_CAPPED, COUNT_CACHED)
+
+
+def has_results(queryset):
+    """
+    Returns True if the queryset matches at least one document, fetching
+    no more than a single document to find it out.
+    """
+    if not hasattr(queryset, '_document'):
+        return len(queryset) > 0
+
+    for obj in queryset.clone().limit(1):
+        return True
+    return False
+
+
+def encode_page_token(direction, values):
+    """
+    Encodes the sort key values of a boundary document in a url-safe token.
+    """
+    data = BSON.encode({'d': direction, 'v': list(values)})
+    return base64.urlsafe_b64encode(str(data)).rstrip('=')
+
+
+def decode_page_token(token):
+    """
+    Decodes a token built by `encode_page_token` and returns a
+    `(direction, values)` tuple. Raises InvalidPage for malformed tokens.
+    """
+    try:
+        token = str(token)
+        data = BSON(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+        data = data.decode()
+        direction, values = data['d'], data['v']
+    except (TypeError, ValueError, KeyError, BSONError, UnicodeError):
+        raise InvalidPage(u'Invalid page token')
+
+    if direction not in (NEXT, PREVIOUS):
+        raise InvalidPage(u'Invalid page token')
+
+    return direction, values
+
+
+class MongoPaginator(Paginator):
+    """
+    A Paginator with pluggable strategies to find out the number of objects
+    of a mongoengine queryset:
+
+    * `exact`: a full `count()` on every page view (Django's behaviour);
+    * `exists`: no count at all, each page fetches one extra document to
+      know if there is a next page;
+    * `estimated`: the document count from the collection metadata when the
+      queryset is unfiltered, an exact count otherwise;
+    * `capped`: counts up to `count_cap` documents, pages beyond the cap are
+      fetched as with `exists`;
+    * `cached`: an exact count kept in Django's cache for
+      `count_cache_timeout` seconds.
+
+    `count_is_exact` tells if `count` is the real number of objects, and
+    `count_label` renders it for templates ("10000+").
+
+    With `raw`, pages hold the raw stored documents, with only `fields`
+    loaded, instead of documents.
+    """
+    def __init__(self, object_list, per_page, orphans=0,
+                 allow_empty_first_page=True, count_strategy=COUNT_EXACT,
+                 count_cap=10000, count_cache_timeout=60, raw=False,
+                 fields=None):
+        super(MongoPaginator, self).__init__(object_list, per_page, orphans,
+                                             allow_empty_first_page)
+        if count_strategy not in COUNT_STRATEGIES:
+            raise ValueError(u'Unknown count strategy: %s' % count_strategy)
+
+        self.count_strategy = count_strategy
+        self.count_cap = count_cap
+        self.count_cache_timeout = count_cache_timeout
+        self.count_is_exact = True
+        self.raw = raw
+        self.fields = fields
+
+    def _is_queryset(self):
+        return hasattr(self.object_list, '_document')
+
+    def _count_objects(self):
+        queryset = self.object_list
+
+        if self.count_strategy == COUNT_ESTIMATED and is_unfiltered(queryset):
+            self.count_is_exact = False
+            return queryset._collection.count()
+
+        elif self.count_strategy == COUNT_CAPPED:
+            # the raw cursor keeps the where clause of the queryset
+            cursor = raw_cursor(queryset, [queryset._document._meta['id_field']])
+            count = cursor.limit(self.count_cap + 1).count(True)
+            if count > self.count_cap:
+                self.count_is_exact = False
+                return self.count_cap
+            return count
+
+        elif self.count_strategy == COUNT_CACHED:
+            key = get_queryset_cache_key('count', queryset)
+            count = cache.get(key)
+            if count is None:
+                count = queryset.count()
+                cache.set(key, count, self.count_cache_timeout)
+            return count
+
+        return queryset.count()
+
+    def _slice(self, bottom, top):
+        if not self.raw:
+            return self.object_list[bottom:top]
+        if top <= bottom:
+            # a limit of 0 means no limit
+            return []
+        cursor = raw_cursor(self.object_list, self.fields)
+        return list(cursor.skip(bottom).limit(top - bottom))
+
+    def _get_count(self):
+        """
+        Returns the total number of objects, across all pages.
+        """
+        if self._count is None:
+            if not self._is_queryset():
+                self._count = len(self.object_list)
+            else:
+                self._count = self._count_objects()
+        return self._count
+    count = property(_get_count)
+
+    def _get_count_label(self):
+        if self.count_is_exact:
+            return u'%s' % self.count
+        return u'%s+' % self.count
+    count_label = property(_get_count_label)
+
+    def _page_without_count(self, number):
+        """
+        Fetches one document past the page to find out if there is a next
+        page, and sets `count` to the lower bound it implies.
+        """
+        bottom = (number - 1) * self.per_page
+        object_list = list(self._slice(bottom, bottom + self.per_page + 1))
+
+        if not object_list and (number > 1 or not self.allow_empty_first_page):
+            raise EmptyPage(u'That page contains no results')
+
+        self.count_is_exact = len(object_list) <= self.per_page
+        self._count = bottom + len(object_list)
+        self._num_pages = None
+        return Page(object_list[:self.per_page], number, self)
+
+    def _validate_page_number(self, number):
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            raise InvalidPage(u'That page number is not an integer')
+        if number < 1:
+            raise EmptyPage(u'That page number is less than 1')
+        return number
+
+    def page(self, number):
+        """
+        Returns a Page object for the given 1-based page number.
+        """
+        if not self._is_queryset():
+            return super(MongoPaginator, self).page(number)
+
+        if self.count_strategy == COUNT_EXISTS:
+            number = self._validate_page_number(number)
+            return self._page_without_count(number)
+
+        # evaluating the count first tells us if the cap was reached
+        if self.count_strategy == COUNT_CAPPED and \
+           self.count == self.count_cap and not self.count_is_exact:
+            number = self._validate_page_number(number)
+            # the last counted page probes for a next one too, as more
+            # documents lie past the cap
+            if number >= self.num_pages:
+                return self._page_without_count(number)
+
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        top = bottom + self.per_page
+        if top + self.orphans >= self.count:
+            top = self.count
+        return Page(self._slice(bottom, top), number, self)
+
+
+class KeysetPage(object):
+    """
+    A page of a `KeysetPaginator`. Mirrors the interface of
+    `django.core.paginator.Page`, but instead of page numbers it exposes
+    tokens to fetch the neighbour pages.
+    """
+    def __init__(self, object_list, paginator, has_next, has_previous):
+        self.object_list = object_list
+        self.paginator = paginator
+        self.number = None
+        self._has_next = has_next
+        self._has_previous = has_previous
+
+    def __repr__(self):
+        return '<Keyset page of %s items>' % len(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+    def next_page_token(self):
+        if not self.has_next():
+            return None
+        return self.paginator.get_token(self.object_list[-1], NEXT)
+
+    def previous_page_token(self):
+        if not self.has_previous():
+            return None
+        return self.paginator.get_token(self.object_list[0], PREVIOUS)
+
+
+class KeysetPaginator(object):
+    """
+    Paginates a mongoengine queryset with range queries over the sort key
+    instead of skip/limit, so fetching a deep page costs the same as
+    fetching the first one.
+
+    `ordering` is the name of the sort field, prefixed by '-' for a
+    descending order. The document id is always used as tiebreaker, so an
+    index on `(ordering, _id)` covers every page query. Documents without
+    a value for the sort field come first, as in MongoDB's sort order.
+
+    With `raw`, pages hold the raw stored documents, with only `fields`
+    (and the sort key) loaded, instead of documents.
+    """
+    def __init__(self, object_list, per_page, ordering=None,
+                 allow_empty_first_page=True, raw=False, fields=None):
+        self.object_list = object_list
+        self.per_page = int(per_page)
+        self.allow_empty_first_page = allow_empty_first_page
+        self.raw = raw
+        self.fields = fields
+
+        document = object_list._document
+        self.document = document
+        self.id_field = document._meta['id_field']
+        self.descending = False
+        self.field = None
+
+        if ordering:
+            self.descending = ordering.startswith('-')
+            self.field = ordering.lstrip('-+')
+            if self.field in ('pk', self.id_field):
+                self.field = None
+
+    def get_key_fields(self):
+        if self.field:
+            return [self.field, self.id_field]
+        return [self.id_field]
+
+    def get_token(self, obj, direction):
+        if self.raw:
+            values = [obj.get(get_db_field(self.document, name))
+                      for name in self.get_key_fields()]
+        else:
+            values = [getattr(obj, name) for name in self.get_key_fields()]
+        return encode_page_token(direction, values)
+
+    def _ordered(self, queryset, reverse):
+        descending = self.descending != reverse
+        sign = descending and '-' or ''
+        return queryset.order_by(
+            *['%s%s' % (sign, name) for name in self.get_key_fields()])
+
+    def _range_query(self, values, reverse):
+        descending = self.descending != reverse
+        op = descending and 'lt' or 'gt'
+
+        if not self.field:
+            return Q(**{'%s__%s' % (self.id_field, op): values[0]})
+
+        key, oid = values
+        same_key = Q(**{self.field: key,
+                        '%s__%s' % (self.id_field, op): oid})
+
+        # null and missing keys sort before any other value, and range
+        # operators never match them, so they are reached explicitly
+        if key is None:
+            if descending:
+                return same_key
+            return same_key | Q(**{'%s__ne' % self.field: None})
+
+        query = Q(**{'%s__%s' % (self.field, op): key}) | same_key
+        if descending:
+            query = query | Q(**{self.field: None})
+        return query
+
+    def page(self, token=None):
+        """
+        Returns the page following (or preceding) the boundary encoded in
+        `token`, or the first page when no token is given.
+        """
+        queryset = self.object_list.clone()
+        direction, values = NEXT, None
+
+        if token:
+            direction, values = decode_page_token(token)
+            if len(values) != len(self.get_key_fields()):
+                raise InvalidPage(u'Invalid page token')
+
+        reverse = direction == PREVIOUS
+        if values is not None:
+            queryset = queryset.filter(self._range_query(values, reverse))
+
+        queryset = self._ordered(queryset, reverse)
+        if self.raw:
+            fields = self.fields
+            if fields is not None:
+                fields = list(fields) + self.get_key_fields()
+            object_list = list(raw_cursor(queryset, fields).limit(
+                self.per_page + 1))
+        else:
+            object_list = list(queryset.limit(self.per_page + 1))
+        has_more = len(object_list) > self.per_page
+        object_list = object_list[:self.per_page]
+
+        if reverse:
+            object_list.reverse()
+            has_next, has_previous = True, has_more
+        else:
+            has_next, has_previous = has_more, values is not None
+
+        if not object_list and values is None and \
+           not self.allow_empty_first_page:
+            raise InvalidPage(u'That page contains no results')
+
+        return KeysetPage(object_list, self, has_next, has_previous)
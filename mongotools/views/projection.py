@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Copyright (C) 2011 Wilson Pinto Júnior <wilsonpjunior@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import types
+
+# value of `list_fields`/`only_fields` that turns on field recording
+AUTO = 'auto'
+
+# fields recorded for each view class
+_recorded_fields = {}
+
+
+def get_recorded_fields(key):
+    """
+    Returns the fields recorded for `key` so far, or None if no response
+    was rendered yet.
+    """
+    return _recorded_fields.get(key)
+
+
+def record_fields(key, fields):
+    """
+    Adds `fields` to the fields recorded for `key`.
+    """
+    _recorded_fields[key] = _recorded_fields.get(key, frozenset()) | \
+        frozenset(fields)
+
+
+def record_on_render(response, key, fields):
+    """
+    Records `fields` for `key` once the response was rendered, that is
+    when the template is done reading the documents.
+    """
+    if hasattr(response, 'add_post_render_callback'):
+        response.add_post_render_callback(
+            lambda response: record_fields(key, fields))
+    else:
+        record_fields(key, fields)
+    return response
+
+
+def _find_document_attr(cls, name):
+    # methods and properties of mongoengine itself are never rebound,
+    # they are internals of the document and must see the real instance
+    for klass in cls.__mro__:
+        if klass is object or klass.__module__.startswith('mongoengine'):
+            continue
+        if name in klass.__dict__:
+            attr = klass.__dict__[name]
+            if isinstance(attr, (types.FunctionType, property)):
+                return attr
+            return None
+    return None
+
+
+class FieldRecorder(object):
+    """
+    Wraps a document and records the names of the fields read from it,
+    either straight from the template or from methods and properties of the
+    document class (like `__unicode__` or `get_absolute_url`).
+
+    `loaded` names the fields the document was loaded with, None if it was
+    loaded whole. Reading any other field loads the whole document first,
+    so a template branch that was never recorded still gets its values.
+    """
+    def __init__(self, obj, accessed, loaded=None):
+        self.__dict__['_obj'] = obj
+        self.__dict__['_accessed'] = accessed
+        self.__dict__['_loaded'] = loaded
+
+    def _load_whole(self):
+        obj = self.__dict__['_obj']
+        whole = obj.__class__.objects.with_id(obj.pk)
+        if whole is not None:
+            obj._data.update(whole._data)
+        self.__dict__['_loaded'] = None
+
+    def __getattr__(self, name):
+        obj = self.__dict__['_obj']
+
+        if name in obj._fields:
+            self.__dict__['_accessed'].add(name)
+            loaded = self.__dict__['_loaded']
+            if loaded is not None and name not in loaded and \
+               name != obj._meta['id_field']:
+                self._load_whole()
+            return getattr(obj, name)
+
+        attr = _find_document_attr(type(obj), name)
+        if isinstance(attr, property):
+            return attr.fget(self)
+        elif attr is not None:
+            return types.MethodType(attr, self)
+
+        return getattr(obj, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.__dict__['_obj'], name, value)
+
+    def __getitem__(self, name):
+        if name in self.__dict__['_obj']._fields:
+            return getattr(self, name)
+        raise KeyError(name)
+
+    def __eq__(self, other):
+        if isinstance(other, FieldRecorder):
+            other = other.__dict__['_obj']
+        return self.__dict__['_obj'] == other
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self.__dict__['_obj'])
+
+    def __unicode__(self):
+        attr = _find_document_attr(type(self.__dict__['_obj']), '__unicode__')
+        if attr is not None:
+            return attr(self)
+        return unicode(self.__dict__['_obj'])
+
+    def __str__(self):
+        attr = _find_document_attr(type(self.__dict__['_obj']), '__str__')
+        if attr is not None:
+            return attr(self)
+        return unicode(self).encode('utf-8')
+
+    def __repr__(self):
+        return repr(self.__dict__['_obj'])
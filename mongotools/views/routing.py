@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Copyright (C) 2011 Wilson Pinto Júnior <wilsonpjunior@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+
+try:
+    from pymongo import read_preferences
+except ImportError:
+    read_preferences = None
+
+# session key holding the time until which reads go to the primary
+PRIMARY_UNTIL_KEY = 'mongotools:primary_until'
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+class ReadRouter(object):
+    """
+    Sends the reads of read-only requests to secondaries.
+
+    `mode` is 'secondaryPreferred', 'secondary' or 'nearest', and
+    `max_staleness` the maxStalenessSeconds of the read preference. pymongo
+    releases without read preference objects (before 3.0) only know
+    `slave_okay`, which reads from a secondary when there is one, and
+    ignore both.
+
+    For `primary_after_write` seconds after a request of the session wrote
+    something, its reads go to the primary again, so users see their own
+    changes. Without sessions only the writing request itself does.
+    """
+    mode = 'secondaryPreferred'
+    max_staleness = None
+    primary_after_write = 10
+
+    def __init__(self, **kwargs):
+        for key, value in kwargs.items():
+            if not hasattr(self.__class__, key):
+                raise TypeError(u"%s got an unexpected keyword argument '%s'"
+                                % (self.__class__.__name__, key))
+            setattr(self, key, value)
+
+    def get_read_preference(self):
+        modes = {
+            'secondaryPreferred': read_preferences.SecondaryPreferred,
+            'secondary': read_preferences.Secondary,
+            'nearest': read_preferences.Nearest,
+        }
+        if self.max_staleness is not None:
+            # maxStalenessSeconds needs pymongo 3.4
+            return modes[self.mode](max_staleness=self.max_staleness)
+        return modes[self.mode]()
+
+    def use_secondary(self, request):
+        if request is None or request.method not in SAFE_METHODS:
+            return False
+
+        session = getattr(request, 'session', None)
+        if session is not None and \
+           session.get(PRIMARY_UNTIL_KEY, 0) > time.time():
+            return False
+        return True
+
+    def route(self, queryset):
+        """returns the queryset reading from secondaries.."""
+        if read_preferences is not None and \
+           hasattr(read_preferences, 'SecondaryPreferred') and \
+           hasattr(queryset, 'read_preference'):
+            return queryset.read_preference(self.get_read_preference())
+        if hasattr(queryset, 'slave_okay'):
+            return queryset.slave_okay(True)
+        return queryset
+
+    def record_write(self, request):
+        session = getattr(request, 'session', None)
+        if session is not None and self.primary_after_write:
+            session[PRIMARY_UNTIL_KEY] = time.time() + self.primary_after_write
+
+
+class ReadRoutingMixin(object):
+    """
+    Routes the queryset of the view with `read_router`, a ReadRouter.
+
+    Views caching what they read (`cache_objects`, `cache_pages` or the
+    `cached` count strategy) read from the primary: a lagging secondary
+    would put outdated documents back in a cache shared by every session.
+    """
+    read_router = None
+
+    def caches_reads(self):
+        return getattr(self, 'cache_objects', False) or \
+            getattr(self, 'cache_pages', False) or \
+            getattr(self, 'count_strategy', None) == 'cached'
+
+    def route_queryset(self, queryset):
+        request = getattr(self, 'request', None)
+        if self.read_router is not None and hasattr(queryset, '_document') \
+           and not self.caches_reads() and \
+           self.read_router.use_secondary(request):
+            return self.read_router.route(queryset)
+        return queryset
+
+    def record_write(self):
+        if self.read_router is not None:
+            self.read_router.record_write(self.request)